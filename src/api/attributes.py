@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import defaultdict, namedtuple
+
+from api.cache import get_versions
+from api.models import Attribute, AttributeValue, ProductAttribute
+
+logger = logging.getLogger(__name__)
+
+TABLES = (Attribute._meta.db_table, AttributeValue._meta.db_table)
+
+# Immutable view of attribute and attribute_value:
+#   attributes: ((attribute_id, name), ...) ordered by attribute_id
+#   attribute_values: {attribute_id: ((attribute_value_id, value), ...)}
+#   values: {attribute_value_id: (attribute_name, attribute_value_id, attribute_value)}
+Snapshot = namedtuple('Snapshot', ('version', 'attributes', 'attribute_values', 'values'))
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def build_snapshot(version):
+    attributes = tuple(Attribute.objects.values_list('attribute_id', 'name').order_by('attribute_id'))
+    names = dict(attributes)
+
+    attribute_values = defaultdict(list)
+    values = {}
+    for value_id, attribute_id, value in AttributeValue.objects.values_list(
+            'attribute_value_id', 'attribute_id', 'value').order_by('attribute_value_id'):
+        attribute_values[attribute_id].append((value_id, value))
+        values[value_id] = (names.get(attribute_id), value_id, value)
+
+    logger.debug("Attribute snapshot built with %s values", len(values))
+    return Snapshot(
+        version=version,
+        attributes=attributes,
+        attribute_values={attribute_id: tuple(rows) for attribute_id, rows in attribute_values.items()},
+        values=values,
+    )
+
+
+def get_snapshot():
+    """
+    Return the current snapshot, built on first use. Checking it is a single
+    cache round-trip; a new one is built and swapped in only when one of the
+    tables changed version.
+    """
+    global _snapshot
+    version = tuple(get_versions(TABLES))
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = build_snapshot(version)
+            snapshot = _snapshot
+    return snapshot
+
+
+def resolve_attributes(product_ids):
+    """
+    Return the attributes of many products, reading their value IDs with one
+    query and the names and values from the snapshot:
+    {product_id: [{'attribute_name', 'attribute_value_id', 'attribute_value'}]}
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+    values = get_snapshot().values
+    product_attributes = defaultdict(list)
+    for product_id, value_id in ProductAttribute.objects.filter(product_id__in=product_ids).values_list(
+            'product_id', 'attribute_value_id'):
+        if value_id in values:
+            product_attributes[product_id].append(values[value_id])
+    # Ordered by attribute name like catalog_get_product_attributes
+    return {
+        product_id: [{'attribute_name': name, 'attribute_value_id': value_id, 'attribute_value': value}
+                     for name, value_id, value in sorted(rows, key=lambda row: (row[0] or '', row[1]))]
+        for product_id, rows in product_attributes.items()
+    }
@@ -0,0 +1,189 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import DataError, IntegrityError, close_old_connections
+from django.utils import timezone
+
+from api.models import Audit
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+# Audit codes of the order lifecycle
+ORDER_CREATED = 10000
+PAYMENT_SUCCEEDED = 20000
+PAYMENT_FAILED = 20001
+
+_STOP = object()
+
+
+def is_permanent(error):
+    """
+    Whether the database refuses the rows themselves, so that no retry can write them
+    """
+    return isinstance(error, (DataError, IntegrityError))
+
+
+class AuditLog:
+    """
+    Buffers audit rows in memory and writes them with bulk_create from a
+    background thread, AUDIT_BATCH_SIZE rows at a time or every
+    AUDIT_FLUSH_INTERVAL seconds.
+
+    A slow or unavailable database never loses rows: a failed write is retried
+    until it goes through, and once AUDIT_BUFFER_SIZE rows are waiting, write()
+    blocks the caller until the buffer drains. Only rows the database refuses
+    (IntegrityError, DataError) are dropped and logged, one by one, so a bad row
+    can't hold up the others. Buffered rows are written at exit.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(settings.AUDIT_BUFFER_SIZE)
+        self._worker = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        atexit.register(self.stop)
+
+    def write(self, order_id, message, code):
+        entry = Audit(order_id=order_id, created_on=timezone.now(), message=message, code=code)
+        if self._stopped:
+            Audit.objects.bulk_create([entry])
+            return
+        self._start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.blocked += 1
+            logger.warning("Audit buffer is full, waiting for the database")
+            self.queue.put(entry)
+
+    def stats(self):
+        """
+        Buffer depth and write metrics, flush times in seconds
+        """
+        return {
+            'depth': self.queue.qsize(),
+            'written': self.written,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'blocked': self.blocked,
+            'dropped': self.dropped,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'avg_flush_seconds': self.flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+    def join(self):
+        """
+        Wait until every buffered row has been written
+        """
+        self.queue.join()
+
+    def stop(self, timeout=30):
+        """
+        Write what is still buffered and stop the worker
+        """
+        self._stopped = True
+        if self._worker is not None and self._worker.is_alive():
+            self.queue.put(_STOP)
+            self._worker.join(timeout)
+
+    def _start(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name='audit-log', daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + settings.AUDIT_FLUSH_INTERVAL
+            while batch[-1] is not _STOP and len(batch) < settings.AUDIT_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            entries = [entry for entry in batch if entry is not _STOP]
+            if entries:
+                self._flush(entries)
+            for _ in batch:
+                self.queue.task_done()
+            if len(entries) < len(batch):
+                close_old_connections()
+                return
+
+    def _flush(self, entries):
+        start = time.monotonic()
+        error = self._write(entries)
+        if error is None:
+            written = len(entries)
+        elif len(entries) == 1:
+            written = 0
+            self._drop(entries, error)
+        else:
+            # One refused row fails the whole INSERT: write the rows one by one
+            # so that only the bad ones are dropped
+            written = 0
+            for entry in entries:
+                error = self._write([entry])
+                if error is None:
+                    written += 1
+                else:
+                    self._drop([entry], error)
+
+        elapsed = time.monotonic() - start
+        self.written += written
+        self.flushes += 1
+        self.flush_seconds += elapsed
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        logger.debug("Wrote %s audit rows in %.3fs, %s buffered", written, elapsed, self.queue.qsize())
+
+    def _write(self, entries):
+        """
+        Insert the rows, retrying until they are written or refused. Returns the
+        error the database refused them with, None once written.
+        """
+        delay = settings.AUDIT_RETRY_DELAY
+        while True:
+            try:
+                Audit.objects.bulk_create(entries)
+                return None
+            except Exception as error:
+                self.failures += 1
+                close_old_connections()
+                if is_permanent(error):
+                    logger.warning("The database refused %s audit rows: %s", len(entries), error)
+                    return error
+                logger.exception("Writing %s audit rows failed, retrying in %ss", len(entries), delay)
+                time.sleep(delay)
+                delay = min(delay * 2, settings.AUDIT_MAX_RETRY_DELAY)
+
+    def _drop(self, entries, reason):
+        self.dropped += len(entries)
+        for entry in entries:
+            logger.error("Dropping audit row of order %s (code %s, %s: %s) the database refused: %s",
+                         entry.order_id, entry.code, entry.created_on, entry.message, reason)
+
+
+audit_log = AuditLog()
+
+
+def audit(order_id, message, code):
+    """
+    Record an event of an order
+    """
+    audit_log.write(order_id, message, code)
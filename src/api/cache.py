@@ -0,0 +1,60 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+
+
+def version_key(table):
+    return 'version:%s' % table
+
+
+def initial_version():
+    """
+    Version given to a table whose key is missing, e.g. after an eviction. It is
+    the time in microseconds, so it is above the versions handed out before and
+    entries or ETags built from those can't be served again.
+    """
+    return int(time.time() * 1000000)
+
+
+def get_version(table):
+    """
+    Return the current version of a table. Every cached entry built from the
+    table embeds this number in its key, so bumping it invalidates them all.
+    """
+    version = cache.get(version_key(table))
+    if version is None:
+        version = initial_version()
+        if not cache.add(version_key(table), version, None):
+            version = cache.get(version_key(table), version)
+    return version
+
+
+def bump_version(table):
+    """
+    Increase the version of a table after one of its rows has changed
+    """
+    try:
+        return cache.incr(version_key(table))
+    except ValueError:
+        version = initial_version()
+        if cache.add(version_key(table), version, None):
+            return version
+        return cache.incr(version_key(table))
+
+
+def versioned_key(table, *parts):
+    """
+    Build a cache key bound to the current version of a table
+    """
+    digest = hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return '%s:v%s:%s' % (table, get_version(table), digest)
+
+
+def get_versions(tables):
+    """
+    Current versions of several tables with a single cache round-trip
+    """
+    keys = [version_key(table) for table in tables]
+    versions = cache.get_many(keys)
+    return [versions.get(key) or get_version(table) for key, table in zip(keys, tables)]
@@ -0,0 +1,835 @@
+import atexit
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from api import errors
+from api.cache import bump_version, get_version
+from api.models import IdSequence, Product, ShoppingCart, ShoppingCartDirty, ShoppingCartSummary
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+ITEM_FIELDS = ('item_id', 'cart_id', 'product_id', 'attributes', 'quantity', 'buy_now', 'added_on', 'version')
+
+
+def to_item(row):
+    item = {field: getattr(row, field) for field in ITEM_FIELDS}
+    item['buy_now'] = bool(item['buy_now'])
+    return item
+
+
+def to_row(item):
+    return ShoppingCart(**dict(item, buy_now=int(item['buy_now'])))
+
+
+def dump_items(items):
+    """
+    JSON of the items of a cart, as kept in shopping_cart_dirty
+    """
+    return json.dumps([dict(item, added_on=item['added_on'].isoformat()) for item in items])
+
+
+def load_items(payload):
+    return [dict(item, added_on=parse_datetime(item['added_on'])) for item in json.loads(payload)]
+
+
+# Items to buy and their subtotal per cart, like shopping_cart_get_total_amount
+SUMMARY_SQL = """
+    SELECT     sc.cart_id, SUM(sc.quantity),
+               SUM(COALESCE(NULLIF(p.discounted_price, 0), p.price) * sc.quantity)
+    FROM       shopping_cart sc
+    INNER JOIN product p
+                 ON sc.product_id = p.product_id
+    WHERE      sc.cart_id IN (%(carts)s) AND sc.buy_now%(condition)s
+    GROUP BY   sc.cart_id
+"""
+
+
+def get_prices(product_ids):
+    """
+    Price of each product, the discounted one when there's one
+    """
+    rows = Product.objects.filter(product_id__in=product_ids).values_list('product_id', 'price', 'discounted_price')
+    return {product_id: discounted_price or price for product_id, price, discounted_price in rows}
+
+
+def with_products(items):
+    """
+    Copy of the items with the name, image and price of their product, leaving
+    out the items whose product doesn't exist anymore
+    """
+    rows = Product.objects.filter(product_id__in={item['product_id'] for item in items}).values_list(
+        'product_id', 'name', 'image', 'price', 'discounted_price')
+    products = {product_id: {'name': name, 'image': image, 'price': discounted_price or price}
+                for product_id, name, image, price, discounted_price in rows}
+    return [dict(item, **products[item['product_id']]) for item in items if item['product_id'] in products]
+
+
+def summarize(items):
+    """
+    (item_count, subtotal) of the items to buy
+    """
+    items = [item for item in items if item['buy_now']]
+    prices = get_prices({item['product_id'] for item in items}) if items else {}
+    items = [item for item in items if item['product_id'] in prices]
+    return (sum(item['quantity'] for item in items),
+            sum((prices[item['product_id']] * item['quantity'] for item in items), Decimal('0.00')))
+
+
+def refresh_summaries(cart_ids):
+    """
+    Recompute the shopping_cart_summary rows of some carts from shopping_cart and product
+    """
+    cart_ids = list(cart_ids)
+    if cart_ids:
+        _refresh_summaries(', '.join(['%s'] * len(cart_ids)), cart_ids)
+
+
+def refresh_item_summary(item_id, without_item=False):
+    """
+    Recompute the summary of the cart of an item, without reading the cart id
+    first. With without_item, the summary leaves the item out, so it can be
+    refreshed before the item is deleted.
+    """
+    carts, params = 'SELECT cart_id FROM shopping_cart WHERE item_id = %s', [item_id]
+    if without_item:
+        _refresh_summaries(carts, params, ' AND sc.item_id <> %s', [item_id])
+    else:
+        _refresh_summaries(carts, params)
+
+
+def _refresh_summaries(carts, params, condition='', condition_params=()):
+    with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+        cursor.execute('DELETE FROM shopping_cart_summary WHERE cart_id IN (%s)' % carts, params)
+        cursor.execute('INSERT INTO shopping_cart_summary (cart_id, item_count, subtotal)' +
+                       SUMMARY_SQL % {'carts': carts, 'condition': condition}, params + list(condition_params))
+
+
+def walk_cart_ids(chunk_size):
+    """
+    Every cart id in shopping_cart, chunk_size at a time
+    """
+    last = ''
+    while True:
+        chunk = list(ShoppingCart.objects.filter(cart_id__gt=last).order_by('cart_id')
+                     .values_list('cart_id', flat=True).distinct()[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+def rebuild_summaries(chunk_size=1000):
+    """
+    Rebuild shopping_cart_summary from the source rows. Returns the number of carts.
+    """
+    carts = 0
+    for chunk in walk_cart_ids(chunk_size):
+        refresh_summaries(chunk)
+        carts += len(chunk)
+    ShoppingCartSummary.objects.exclude(cart_id__in=ShoppingCart.objects.values('cart_id')).delete()
+    logger.debug("Rebuilt the summaries of %s carts", carts)
+    return carts
+
+
+def check_summaries(chunk_size=1000):
+    """
+    Return the ids of the carts whose summary doesn't match their rows
+    """
+    stale = []
+    for chunk in walk_cart_ids(chunk_size):
+        with connection.cursor() as cursor:
+            cursor.execute(SUMMARY_SQL % {'carts': ', '.join(['%s'] * len(chunk)), 'condition': ''}, chunk)
+            expected = {cart_id: (int(count), Decimal(subtotal)) for cart_id, count, subtotal in cursor.fetchall()}
+        actual = {cart_id: (count, subtotal) for cart_id, count, subtotal in ShoppingCartSummary.objects.filter(
+            cart_id__in=chunk).values_list('cart_id', 'item_count', 'subtotal')}
+        stale += [cart_id for cart_id in chunk if expected.get(cart_id) != actual.get(cart_id)]
+    stale += ShoppingCartSummary.objects.exclude(
+        cart_id__in=ShoppingCart.objects.values('cart_id')).values_list('cart_id', flat=True)
+    return stale
+
+
+def carts_with_products(product_ids, chunk_size):
+    """
+    Ids of the carts holding any of the products, chunk_size at a time, read from
+    the (product_id, cart_id) index of shopping_cart
+    """
+    last = ''
+    while True:
+        chunk = list(ShoppingCart.objects.filter(product_id__in=product_ids, cart_id__gt=last).order_by('cart_id')
+                     .values_list('cart_id', flat=True).distinct()[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+def propagate_prices(product_ids, chunk_size=500, progress=None):
+    """
+    Bring the carts holding some products up to date after their prices changed.
+    Only those carts get their summary recomputed, a chunk per transaction;
+    progress(done, total) is called after each chunk. Returns the number of carts.
+    """
+    product_ids = list(product_ids)
+    # Cached cart summaries are bound to the product version
+    bump_version(Product._meta.db_table)
+    total = ShoppingCart.objects.filter(product_id__in=product_ids).values('cart_id').distinct().count()
+    done = 0
+    for chunk in carts_with_products(product_ids, chunk_size):
+        refresh_summaries(chunk)
+        done += len(chunk)
+        if progress:
+            progress(done, total)
+    logger.info("Propagated the prices of %s products to %s carts", len(product_ids), done)
+    return done
+
+
+def reserve_item_ids(count):
+    """
+    Reserve count consecutive item ids for rows written to shopping_cart later,
+    returning the first. The counter lives in id_sequence, so ids are never handed
+    out twice, and it never falls behind the ids already in shopping_cart.
+    """
+    name = ShoppingCart._meta.db_table + '.item_id'
+    last_item_id = Coalesce(Subquery(ShoppingCart.objects.order_by('-item_id').values('item_id')[:1]), Value(0))
+    sequence = IdSequence.objects.filter(name=name)
+    with transaction.atomic():
+        # Update first, so concurrent reservations queue on the row lock
+        if not sequence.update(last_value=Greatest(F('last_value'), last_item_id) + count):
+            IdSequence.objects.get_or_create(name=name)
+            sequence.update(last_value=Greatest(F('last_value'), last_item_id) + count)
+        return sequence.values_list('last_value', flat=True).get() - count + 1
+
+
+class CartOperationError(Exception):
+    def __init__(self, error):
+        super().__init__(error.message)
+        self.error = error
+
+
+def apply_operations(items, operations, next_item_id=None):
+    """
+    Apply a batch of operations to the items of a cart, in place. New items get
+    their id from next_item_id(), or None when the database assigns it.
+    Every change bumps the version of the item; an operation carrying a version
+    only applies to the item at that version.
+    Raises CartOperationError when an operation refers to an item not in the
+    cart, or to a version that is not the current one.
+    """
+    by_id = {item['item_id']: item for item in items}
+    for operation in operations:
+        action = operation['action']
+        if action == 'add':
+            quantity = operation.get('quantity', 1)
+            for item in items:
+                if item['product_id'] == operation['product_id'] and item['attributes'] == operation['attributes']:
+                    item['quantity'] += quantity
+                    item['buy_now'] = True
+                    item['version'] += 1
+                    break
+            else:
+                items.append({'item_id': next_item_id() if next_item_id else None, 'cart_id': None,
+                              'product_id': operation['product_id'], 'attributes': operation['attributes'],
+                              'quantity': quantity, 'buy_now': True, 'added_on': timezone.now(), 'version': 0})
+            continue
+
+        item = by_id.get(operation['item_id'])
+        if item is None:
+            raise CartOperationError(errors.SHP_02)
+        if operation.get('version') is not None and operation['version'] != item['version']:
+            raise CartOperationError(errors.SHP_03)
+        item['version'] += 1
+        if action == 'remove' or (action == 'update' and operation['quantity'] <= 0):
+            items.remove(item)
+            del by_id[item['item_id']]
+        elif action == 'update':
+            item['quantity'] = operation['quantity']
+            item['added_on'] = timezone.now()
+        elif action == 'save':
+            item['buy_now'] = False
+            item['quantity'] = 1
+        elif action == 'move':
+            item['buy_now'] = True
+            item['added_on'] = timezone.now()
+    return items
+
+
+class CartStorage:
+    """
+    Storage engine behind the shopping cart endpoints. Items are dicts with
+    the columns of shopping_cart.
+    """
+
+    def get_items(self, cart_id):
+        raise NotImplementedError
+
+    def get_item(self, item_id):
+        raise NotImplementedError
+
+    def add(self, cart_id, product_id, attributes, quantity=1):
+        """
+        Add a product, or increase the quantity of the item with the same product and attributes
+        """
+        raise NotImplementedError
+
+    def update_quantity(self, item_id, quantity, version=None):
+        """
+        Set the quantity of an item, removing it when the quantity isn't positive.
+        Returns the id of its cart, None when the item doesn't exist.
+
+        The item methods take the version the client last read: when given, the
+        change only applies if the item is still at that version, and
+        CartOperationError(SHP_03) is raised otherwise.
+        """
+        raise NotImplementedError
+
+    def remove(self, item_id, version=None):
+        """
+        Returns whether the item existed
+        """
+        raise NotImplementedError
+
+    def move(self, item_id, buy_now, version=None):
+        """
+        Move an item between the cart (buy_now) and the saved for later list.
+        Returns whether the item exists.
+        """
+        raise NotImplementedError
+
+    def empty(self, cart_id):
+        raise NotImplementedError
+
+    def apply(self, cart_id, operations):
+        """
+        Apply a batch of operations all together or not at all, and return the resulting items
+        """
+        raise NotImplementedError
+
+    def get_summary(self, cart_id):
+        """
+        (item_count, subtotal) of the products to buy in a cart, kept up to date by every change
+        """
+        raise NotImplementedError
+
+    def get_products(self, cart_id, buy_now=True):
+        """
+        Items of the cart (buy_now) or of the saved for later list, with_products()
+        """
+        return with_products([item for item in self.get_items(cart_id) if item['buy_now'] == buy_now])
+
+    def flush(self):
+        """
+        Persist pending changes, for storages that buffer them
+        """
+
+    @contextmanager
+    def reaping(self, cart_ids):
+        """
+        Hold carts the reaper found idle while their rows are deleted from
+        shopping_cart, yielding the ids of those that may go
+        """
+        yield set(cart_ids)
+
+    @contextmanager
+    def checkout(self, cart_id):
+        """
+        Hold a cart, with its items in shopping_cart, while it is turned into an
+        order; the order is expected to leave the cart empty
+        """
+        yield
+
+
+class DatabaseCartStorage(CartStorage):
+    """
+    Reads and writes shopping_cart directly
+    """
+
+    def get_items(self, cart_id):
+        return [to_item(row) for row in ShoppingCart.objects.filter(cart_id=cart_id).order_by('item_id')]
+
+    def get_item(self, item_id):
+        row = ShoppingCart.objects.filter(item_id=item_id).first()
+        return to_item(row) if row else None
+
+    def get_products(self, cart_id, buy_now=True):
+        items = ShoppingCart.objects.filter(cart_id=cart_id)
+        items = items.active() if buy_now else items.saved()
+        return [dict(item, buy_now=bool(item['buy_now']))
+                for item in items.with_products().order_by('item_id').values(*ITEM_FIELDS, 'name', 'image', 'price')]
+
+    def get_summary(self, cart_id):
+        summary = ShoppingCartSummary.objects.filter(cart_id=cart_id).values_list('item_count', 'subtotal').first()
+        return summary or (0, Decimal('0.00'))
+
+    def add(self, cart_id, product_id, attributes, quantity=1):
+        with transaction.atomic():
+            self._upsert(cart_id, [(product_id, attributes, quantity)])
+            refresh_summaries([cart_id])
+
+    @staticmethod
+    def _upsert(cart_id, products):
+        """
+        Add (product_id, attributes, quantity) products to a cart with a single
+        statement against the unique key on (cart_id, product_id, attributes):
+        concurrent adds of the same product can neither duplicate the row nor lose
+        an increment
+        """
+        now, params = timezone.now(), []
+        for product_id, attributes, quantity in products:
+            params += [cart_id, product_id, attributes, quantity, now]
+        if connection.vendor == 'mysql':
+            sql = """
+                INSERT INTO shopping_cart (cart_id, product_id, attributes, quantity, buy_now, added_on, version)
+                VALUES %s
+                ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity), buy_now = true,
+                                        version = version + 1
+            """ % ', '.join(['(%s, %s, %s, %s, true, %s, 0)'] * len(products))
+        else:
+            sql = """
+                INSERT INTO shopping_cart (cart_id, product_id, attributes, quantity, buy_now, added_on, version)
+                VALUES %s
+                ON CONFLICT (cart_id, product_id, attributes)
+                DO UPDATE SET quantity = shopping_cart.quantity + excluded.quantity, buy_now = 1,
+                              version = shopping_cart.version + 1
+            """ % ', '.join(['(%s, %s, %s, %s, 1, %s, 0)'] * len(products))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    @staticmethod
+    def _conditional(item_id, version):
+        items = ShoppingCart.objects.filter(item_id=item_id)
+        return items if version is None else items.filter(version=version)
+
+    @staticmethod
+    def _conflict(item_id):
+        """
+        A conditional statement touched nothing: the item is gone or at another version
+        """
+        if ShoppingCart.objects.filter(item_id=item_id).exists():
+            raise CartOperationError(errors.SHP_03)
+
+    @staticmethod
+    def _cart_of(item_id):
+        return ShoppingCart.objects.filter(item_id=item_id).values_list('cart_id', flat=True).first()
+
+    # Each change is a single conditional statement: concurrent requests can't
+    # lose each other's updates, and a stale version matches no row. Cart
+    # summaries are refreshed through the item, so no read comes first.
+
+    def update_quantity(self, item_id, quantity, version=None):
+        if quantity <= 0:
+            # The cart id to return can only be read while the item is there
+            cart_id = self._cart_of(item_id)
+            return cart_id if cart_id is not None and self.remove(item_id, version) else None
+        with transaction.atomic():
+            if not self._conditional(item_id, version).update(quantity=quantity, added_on=timezone.now(),
+                                                              version=F('version') + 1):
+                self._conflict(item_id)
+                return None
+            # Read under the row lock the update took
+            cart_id = self._cart_of(item_id)
+            refresh_summaries([cart_id])
+        return cart_id
+
+    def remove(self, item_id, version=None):
+        with transaction.atomic():
+            # Left out of the summary before it goes; a conflict rolls the summary back
+            refresh_item_summary(item_id, without_item=True)
+            if not self._conditional(item_id, version).delete()[0]:
+                self._conflict(item_id)
+                return False
+        return True
+
+    def move(self, item_id, buy_now, version=None):
+        changes = {'buy_now': True, 'added_on': timezone.now()} if buy_now else {'buy_now': False, 'quantity': 1}
+        with transaction.atomic():
+            if not self._conditional(item_id, version).update(version=F('version') + 1, **changes):
+                self._conflict(item_id)
+                return False
+            refresh_item_summary(item_id)
+        return True
+
+    def empty(self, cart_id):
+        with transaction.atomic():
+            ShoppingCart.objects.filter(cart_id=cart_id).delete()
+            ShoppingCartSummary.objects.filter(cart_id=cart_id).delete()
+
+    def apply(self, cart_id, operations):
+        with transaction.atomic():
+            before = {row.item_id: to_item(row)
+                      for row in ShoppingCart.objects.select_for_update().filter(cart_id=cart_id)}
+            items = apply_operations([dict(item) for item in before.values()], operations)
+            for item in items:
+                item['cart_id'] = cart_id
+
+            removed = set(before) - {item['item_id'] for item in items}
+            changed = [to_row(item) for item in items
+                       if item['item_id'] in before and item != before[item['item_id']]]
+            created = [item for item in items if item['item_id'] is None]
+            if removed:
+                ShoppingCart.objects.filter(item_id__in=removed).delete()
+            if changed:
+                ShoppingCart.objects.bulk_update(changed, ['quantity', 'buy_now', 'added_on', 'version'])
+            if created:
+                # A concurrent add of the same product may have inserted its row since the cart was read
+                self._upsert(cart_id, [(item['product_id'], item['attributes'], item['quantity'])
+                                       for item in created])
+            refresh_summaries([cart_id])
+        return self.get_items(cart_id) if created else sorted(items, key=lambda item: item['item_id'])
+
+
+class CacheCartStorage(CartStorage):
+    """
+    Keeps whole carts in a shared cache and writes them behind to shopping_cart.
+
+    Every mutation also stores the items of its cart in shopping_cart_dirty, one
+    statement, and a background thread persists dirty carts to shopping_cart in
+    batches every CART_FLUSH_INTERVAL seconds. The dirty copies are in the
+    database, so a cart the cache evicts before it is flushed loses nothing, and
+    any process flushes the carts another one changed before it stopped. The cache
+    named by CART_CACHE is the shared store (memcached or Redis in production,
+    local memory in development). New items get their id from id_sequence,
+    CART_ITEM_ID_BLOCK at a time.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.CART_CACHE]
+        self.timeout = settings.CART_CACHE_TIMEOUT
+        self.interval = settings.CART_FLUSH_INTERVAL
+        self._item_ids = iter(())
+        self._item_ids_lock = threading.Lock()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        atexit.register(self._flush_at_exit)
+
+    @staticmethod
+    def cart_key(cart_id):
+        return 'cart:%s' % cart_id
+
+    @staticmethod
+    def item_key(item_id):
+        return 'cart:item:%s' % item_id
+
+    @staticmethod
+    def summary_key(cart_id):
+        # Bound to the product version: a price change makes every cached summary stale
+        return 'cart:summary:v%s:%s' % (get_version(Product._meta.db_table), cart_id)
+
+    @contextmanager
+    def lock(self, cart_id):
+        """
+        Cross-process lock on a cart, built on the atomic cache.add()
+        """
+        key, token = 'cart:lock:%s' % cart_id, uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CART_LOCK_TIMEOUT
+        while not self.cache.add(key, token, settings.CART_LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                raise TimeoutError('Cart %s is locked' % cart_id)
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            if self.cache.get(key) == token:
+                self.cache.delete(key)
+
+    def _load(self, cart_id):
+        items = self.cache.get(self.cart_key(cart_id))
+        if items is not None:
+            return items
+        # Changes not flushed yet are newer than the rows
+        items = self._pending([cart_id]).get(cart_id)
+        if items is None:
+            items = [to_item(row) for row in ShoppingCart.objects.filter(cart_id=cart_id).order_by('item_id')]
+        # Read without the cart lock: add() never overwrites a newer cart saved meanwhile
+        if not self.cache.add(self.cart_key(cart_id), items, self.timeout):
+            items = self.cache.get(self.cart_key(cart_id), items)
+        self.cache.set_many({self.item_key(item['item_id']): cart_id for item in items}, self.timeout)
+        return items
+
+    @staticmethod
+    def _pending(cart_ids):
+        """
+        Items of those of the carts with changes not flushed yet
+        """
+        return {cart_id: load_items(payload) for cart_id, payload in
+                ShoppingCartDirty.objects.filter(cart_id__in=list(cart_ids)).values_list('cart_id', 'items')}
+
+    def _save(self, cart_id, items):
+        """
+        Store the items of a cart, with the cart lock held
+        """
+        # Stored first: a crash in between leaves the cache behind the durable copy, not ahead of it
+        self._mark_dirty(cart_id, items)
+        self.cache.set_many({self.cart_key(cart_id): items, self.summary_key(cart_id): summarize(items)},
+                            self.timeout)
+        self._start_flusher()
+
+    @staticmethod
+    def _mark_dirty(cart_id, items):
+        if connection.vendor == 'mysql':
+            sql = """
+                INSERT INTO shopping_cart_dirty (cart_id, items) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE items = VALUES(items)
+            """
+        else:
+            sql = """
+                INSERT INTO shopping_cart_dirty (cart_id, items) VALUES (%s, %s)
+                ON CONFLICT (cart_id) DO UPDATE SET items = excluded.items
+            """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [cart_id, dump_items(items)])
+
+    def _next_item_id(self):
+        with self._item_ids_lock:
+            item_id = next(self._item_ids, None)
+            if item_id is None:
+                first = reserve_item_ids(settings.CART_ITEM_ID_BLOCK)
+                self._item_ids = iter(range(first, first + settings.CART_ITEM_ID_BLOCK))
+                item_id = next(self._item_ids)
+        return item_id
+
+    def _cart_of(self, item_id):
+        cart_id = self.cache.get(self.item_key(item_id))
+        if cart_id is None:
+            cart_id = ShoppingCart.objects.filter(item_id=item_id).values_list('cart_id', flat=True).first()
+        return cart_id
+
+    def _apply_to_item(self, item_id, operation):
+        """
+        Apply one operation to an item, returning the id of its cart or None when it doesn't exist.
+        There's no conditional UPDATE here: apply_operations checks the version under the cart
+        lock, and the flush writes the result with the lock still held.
+        """
+        cart_id = self._cart_of(item_id)
+        if cart_id is None:
+            return None
+        try:
+            self.apply(cart_id, [dict(operation, item_id=item_id)])
+        except CartOperationError as error:
+            if error.error is errors.SHP_02:
+                return None
+            raise
+        return cart_id
+
+    def get_items(self, cart_id):
+        return self._load(cart_id)
+
+    def get_summary(self, cart_id):
+        summary = self.cache.get(self.summary_key(cart_id))
+        if summary is None:
+            summary = summarize(self._load(cart_id))
+            self.cache.add(self.summary_key(cart_id), summary, self.timeout)
+        return summary
+
+    def get_item(self, item_id):
+        cart_id = self._cart_of(item_id)
+        if cart_id is None:
+            return None
+        return next((item for item in self._load(cart_id) if item['item_id'] == item_id), None)
+
+    def add(self, cart_id, product_id, attributes, quantity=1):
+        # Merged into the cart under its lock, which the flush also holds while it
+        # replaces the rows of the cart: concurrent adds can neither duplicate an
+        # item nor lose an increment, so the rows need no upsert
+        self.apply(cart_id, [{'action': 'add', 'product_id': product_id, 'attributes': attributes,
+                              'quantity': quantity}])
+
+    def update_quantity(self, item_id, quantity, version=None):
+        return self._apply_to_item(item_id, {'action': 'update', 'quantity': quantity, 'version': version})
+
+    def remove(self, item_id, version=None):
+        return self._apply_to_item(item_id, {'action': 'remove', 'version': version}) is not None
+
+    def move(self, item_id, buy_now, version=None):
+        operation = {'action': 'move' if buy_now else 'save', 'version': version}
+        return self._apply_to_item(item_id, operation) is not None
+
+    def empty(self, cart_id):
+        with self.lock(cart_id):
+            self._save(cart_id, [])
+
+    def apply(self, cart_id, operations):
+        with self.lock(cart_id):
+            items = apply_operations([dict(item) for item in self._load(cart_id)], operations, self._next_item_id)
+            for item in items:
+                if item['cart_id'] is None:
+                    item['cart_id'] = cart_id
+                    self.cache.set(self.item_key(item['item_id']), cart_id, self.timeout)
+            self._save(cart_id, items)
+        return items
+
+    @contextmanager
+    def reaping(self, cart_ids):
+        with ExitStack() as locks:
+            held = set()
+            for cart_id in cart_ids:
+                try:
+                    locks.enter_context(self.lock(cart_id))
+                except TimeoutError:
+                    continue
+                held.add(cart_id)
+            # A cart with changes not flushed yet was used recently, whatever its rows say
+            idle = held - set(ShoppingCartDirty.objects.filter(cart_id__in=held).values_list('cart_id', flat=True))
+            yield idle
+            self.cache.delete_many([key for cart_id in idle
+                                    for key in (self.cart_key(cart_id), self.summary_key(cart_id))])
+
+    def _start_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            with self._flusher_lock:
+                if self._flusher is None or not self._flusher.is_alive():
+                    self._flusher = threading.Thread(target=self._run_flusher, name='cart-flusher', daemon=True)
+                    self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing carts failed, retrying in %s seconds", self.interval)
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing carts at exit failed, they stay dirty")
+
+    def flush(self):
+        """
+        Write every dirty cart to shopping_cart, CART_FLUSH_BATCH_SIZE carts per
+        transaction. A cart that can't be written stays dirty for the next run
+        without holding back the others. Returns the number of carts written.
+        """
+        flushed, last = 0, ''
+        while True:
+            cart_ids = list(ShoppingCartDirty.objects.filter(cart_id__gt=last).order_by('cart_id')
+                            .values_list('cart_id', flat=True)[:settings.CART_FLUSH_BATCH_SIZE])
+            if not cart_ids:
+                break
+            last = cart_ids[-1]
+            flushed += self._flush_batch(cart_ids)
+        if flushed:
+            logger.debug("Flushed %s carts", flushed)
+        return flushed
+
+    def _flush_batch(self, cart_ids):
+        with ExitStack() as locks:
+            # The locks are held until the rows are written, so no newer change can be overwritten
+            held = []
+            for cart_id in cart_ids:
+                try:
+                    locks.enter_context(self.lock(cart_id))
+                except TimeoutError:
+                    logger.warning("Cart %s is locked, flushing it on the next run", cart_id)
+                    continue
+                held.append(cart_id)
+            # Written from the durable copies, which the cache may have evicted
+            carts = self._pending(held)
+            try:
+                self._write(carts)
+                return len(carts)
+            except Exception:
+                logger.exception("Flushing %s carts failed, writing them one at a time", len(carts))
+            written = 0
+            for cart_id, items in carts.items():
+                try:
+                    self._write({cart_id: items})
+                    written += 1
+                except Exception:
+                    logger.exception("Flushing cart %s failed, it stays dirty", cart_id)
+            return written
+
+    @staticmethod
+    def _write(carts):
+        """
+        Replace the rows of some carts in shopping_cart with their items and clear
+        their dirty marks, with the cart locks held
+        """
+        with transaction.atomic():
+            ShoppingCart.objects.filter(cart_id__in=list(carts)).delete()
+            ShoppingCart.objects.bulk_create([to_row(item) for items in carts.values() for item in items])
+            refresh_summaries(carts)
+            ShoppingCartDirty.objects.filter(cart_id__in=list(carts)).delete()
+
+    @contextmanager
+    def checkout(self, cart_id):
+        with self.lock(cart_id):
+            carts = self._pending([cart_id])
+            if carts:
+                self._write(carts)
+            yield
+            self.cache.set_many({self.cart_key(cart_id): [], self.summary_key(cart_id): summarize([])},
+                                self.timeout)
+
+
+_storage = None
+
+
+def active_carts(cart_ids, cutoff):
+    """
+    Those of the carts with an item changed since cutoff
+    """
+    return set(ShoppingCart.objects.filter(cart_id__in=cart_ids, added_on__gte=cutoff)
+               .values_list('cart_id', flat=True).distinct())
+
+
+def reap_carts(ttl=None, chunk_size=None, pause=None):
+    """
+    Delete the carts not changed for ttl seconds (CART_TTL).
+
+    Rows are walked in item_id order, chunk_size at a time, each chunk deleted
+    by primary key in its own short statement with a pause in between, so the
+    job never holds many locks for long. Rows of carts with a recent item, or
+    with changes the storage hasn't written yet, are kept. Returns (rows
+    deleted, seconds taken).
+    """
+    ttl = settings.CART_TTL if ttl is None else ttl
+    chunk_size = chunk_size or settings.CART_REAP_CHUNK_SIZE
+    pause = settings.CART_REAP_PAUSE if pause is None else pause
+    cutoff = timezone.now() - timedelta(seconds=ttl)
+    started, deleted, last = time.monotonic(), 0, 0
+
+    while True:
+        chunk = list(ShoppingCart.objects.filter(item_id__gt=last, added_on__lt=cutoff)
+                     .order_by('item_id').values_list('item_id', 'cart_id')[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        cart_ids = {cart_id for _, cart_id in chunk}
+        idle = cart_ids - active_carts(cart_ids, cutoff)
+        with get_storage().reaping(idle) as held:
+            # Checked again now that nothing can write the carts, e.g. the cache storage's flusher
+            idle = held - active_carts(held, cutoff)
+            item_ids = [item_id for item_id, cart_id in chunk if cart_id in idle]
+            if item_ids:
+                deleted += ShoppingCart.objects.filter(item_id__in=item_ids).delete()[0]
+                refresh_summaries(idle)
+        if len(chunk) < chunk_size:
+            break
+        time.sleep(pause)
+
+    seconds = time.monotonic() - started
+    logger.info("Reaped %s cart rows idle since %s in %.1f seconds", deleted, cutoff, seconds)
+    return deleted, seconds
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = import_string(settings.CART_STORAGE)()
+    return _storage
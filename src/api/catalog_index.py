@@ -0,0 +1,160 @@
+import bisect
+import logging
+import threading
+from array import array
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from api.cache import bump_version, get_version
+from api.models import Category, ProductCategory
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_CATEGORY = ProductCategory._meta.db_table
+CATEGORY = Category._meta.db_table
+
+
+def delta_key(version):
+    return 'membership:delta:%s' % version
+
+
+def record_change(change):
+    """
+    Bump the version of product_category and publish the change that produced
+    it, as (product_id, category_id, added), so the index of every process can
+    apply it instead of rebuilding. A change of None forces a rebuild.
+    """
+    version = bump_version(PRODUCT_CATEGORY)
+    if change is not None:
+        cache.set(delta_key(version), change, settings.MEMBERSHIP_DELTA_TIMEOUT)
+
+
+class MembershipIndex:
+    """
+    Sorted arrays of product IDs per category and per department, so a listing
+    page is a slice of an array followed by one primary key fetch.
+
+    Every process applies the changes of product_category published since its
+    version, and rebuilds its copy from the tables when one of them is missing
+    or the category table has changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._version = None
+        self._categories = {}
+        self._departments = {}
+        self._category_department = {}
+
+    @staticmethod
+    def current_version():
+        return get_version(PRODUCT_CATEGORY), get_version(CATEGORY)
+
+    def _build(self):
+        category_department = dict(Category.objects.values_list('category_id', 'department_id'))
+        categories = defaultdict(lambda: array('i'))
+        for product_id, category_id in ProductCategory.objects.values_list(
+                'product_id', 'category_id').order_by('category_id', 'product_id').iterator():
+            categories[category_id].append(product_id)
+
+        department_products = defaultdict(set)
+        for category_id, product_ids in categories.items():
+            department_products[category_department.get(category_id)].update(product_ids)
+
+        self._category_department = category_department
+        self._categories = {category_id: categories.get(category_id, array('i'))
+                            for category_id in category_department}
+        self._departments = {department_id: array('i', sorted(department_products.get(department_id, ())))
+                             for department_id in set(category_department.values())}
+        logger.debug("Membership index built for %s categories", len(self._categories))
+
+    def _refresh(self):
+        version = self.current_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    if not self._apply_changes(version):
+                        self._build()
+                    self._version = version
+
+    def _apply_changes(self, version):
+        """
+        Catch up with version from the published changes. Returns False when
+        they don't cover the gap and the index must be rebuilt.
+        """
+        if self._version is None or version[1] != self._version[1]:
+            return False
+        versions = range(self._version[0] + 1, version[0] + 1)
+        if not 0 < len(versions) <= settings.MEMBERSHIP_MAX_DELTAS:
+            return False
+        keys = [delta_key(number) for number in versions]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys):
+            return False
+        for key in keys:
+            if not self._apply(*changes[key]):
+                return False
+        logger.debug("Membership index caught up with %s changes", len(keys))
+        return True
+
+    def _apply(self, product_id, category_id, added):
+        """
+        Add a product to a category, or remove it from a category or, with
+        category_id None, from all of them. Arrays are replaced rather than
+        changed in place as readers use them without the lock.
+        """
+        if category_id is None:
+            category_ids = [category_id for category_id, products in self._categories.items()
+                            if contains(products, product_id)]
+        elif category_id in self._categories:
+            category_ids = [category_id]
+        else:
+            return False
+
+        for category_id in category_ids:
+            self._categories[category_id] = changed(self._categories[category_id], product_id, added)
+            department_id = self._category_department[category_id]
+            if not added and any(contains(self._categories[other], product_id)
+                                 for other, department in self._category_department.items()
+                                 if department == department_id):
+                # Still listed in another category of the department
+                continue
+            self._departments[department_id] = changed(self._departments[department_id], product_id, added)
+        return True
+
+    def products_in_category(self, category_id):
+        """
+        Sorted product IDs of a category, or None if the category doesn't exist
+        """
+        self._refresh()
+        return self._categories.get(category_id)
+
+    def products_in_department(self, department_id):
+        """
+        Sorted product IDs of a department, or None if it has no categories
+        """
+        self._refresh()
+        return self._departments.get(department_id)
+
+
+def contains(products, product_id):
+    position = bisect.bisect_left(products, product_id)
+    return position < len(products) and products[position] == product_id
+
+
+def changed(products, product_id, added):
+    """
+    Copy of a sorted array with product_id added or removed
+    """
+    position = bisect.bisect_left(products, product_id)
+    present = position < len(products) and products[position] == product_id
+    if added == present:
+        return products
+    if added:
+        return products[:position] + array('i', [product_id]) + products[position:]
+    return products[:position] + products[position + 1:]
+
+
+index = MembershipIndex()
@@ -0,0 +1,65 @@
+import logging
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api import errors
+from api.cart_store import CartOperationError, get_storage
+from api.models import Shipping, ShoppingCart, ShoppingCartSummary, Tax
+
+logger = logging.getLogger(__name__)
+
+# Order header with the cart total, tax and shipping; no row when the cart is
+# empty or the tax or shipping doesn't exist
+ORDER_SQL = """
+    INSERT INTO orders (total_amount, created_on, status, customer_id, shipping_id, tax_id)
+    SELECT      ROUND(SUM(COALESCE(NULLIF(p.discounted_price, 0), p.price) * sc.quantity)
+                      * (100 + t.tax_percentage) / 100 + s.shipping_cost, 2),
+                %s, 0, %s, s.shipping_id, t.tax_id
+    FROM        shopping_cart sc
+    INNER JOIN  product p
+                  ON sc.product_id = p.product_id
+    INNER JOIN  tax t
+                  ON t.tax_id = %s
+    INNER JOIN  shipping s
+                  ON s.shipping_id = %s
+    WHERE       sc.cart_id = %s AND sc.buy_now
+    GROUP BY    t.tax_id, t.tax_percentage, s.shipping_id, s.shipping_cost
+"""
+
+# Lines of the order, like shopping_cart_create_order
+ORDER_DETAIL_SQL = """
+    INSERT INTO order_detail (order_id, product_id, attributes, product_name, quantity, unit_cost)
+    SELECT      %s, p.product_id, sc.attributes, p.name, sc.quantity,
+                COALESCE(NULLIF(p.discounted_price, 0), p.price)
+    FROM        shopping_cart sc
+    INNER JOIN  product p
+                  ON sc.product_id = p.product_id
+    WHERE       sc.cart_id = %s AND sc.buy_now
+"""
+
+
+def place_order(cart_id, customer_id, shipping_id, tax_id):
+    """
+    Turn a cart into an order with a fixed number of set-based statements in one
+    transaction, whatever the number of items: the order with its total, its
+    lines copied from the cart, then the cart emptied. Returns the order id.
+    """
+    with get_storage().checkout(cart_id), transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(ORDER_SQL, [timezone.now(), customer_id, tax_id, shipping_id, cart_id])
+        if not cursor.rowcount:
+            raise CartOperationError(find_order_error(shipping_id, tax_id))
+        order_id = cursor.lastrowid
+        cursor.execute(ORDER_DETAIL_SQL, [order_id, cart_id])
+        ShoppingCart.objects.filter(cart_id=cart_id).delete()
+        ShoppingCartSummary.objects.filter(cart_id=cart_id).delete()
+    logger.debug("Order %s created from cart %s", order_id, cart_id)
+    return order_id
+
+
+def find_order_error(shipping_id, tax_id):
+    if not Tax.objects.filter(tax_id=tax_id).exists():
+        return errors.ORD_03
+    if not Shipping.objects.filter(shipping_id=shipping_id).exists():
+        return errors.ORD_04
+    return errors.SHP_01
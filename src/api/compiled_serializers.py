@@ -0,0 +1,102 @@
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+# Representations that return a database value unchanged
+IDENTITY_REPRESENTATIONS = (serializers.IntegerField.to_representation, serializers.CharField.to_representation,
+                            serializers.ReadOnlyField.to_representation)
+
+
+def decimal_converter(field):
+    """
+    Database decimals already have the field's scale, so they only need formatting.
+    Anything else goes through the field.
+    """
+    if not getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING) or field.localize:
+        return field.to_representation
+    exponent = -field.decimal_places if field.decimal_places is not None else None
+    fallback = field.to_representation
+
+    def convert(value):
+        if value.as_tuple().exponent == exponent:
+            return '{0:f}'.format(value)
+        return fallback(value)
+
+    return convert
+
+
+def get_converter(field):
+    if type(field).to_representation in IDENTITY_REPRESENTATIONS:
+        return None
+    if isinstance(field, serializers.DecimalField):
+        return decimal_converter(field)
+    return field.to_representation
+
+
+class CompiledSerializer:
+    """
+    Serializes `.values_list()` rows with a function generated from the fields of a
+    ModelSerializer, producing exactly what the serializer would for the same rows.
+    Only fields mapped to a model column are supported.
+    """
+
+    def __init__(self, serializer_class):
+        fields = [(name, field) for name, field in serializer_class().fields.items() if not field.write_only]
+        for name, field in fields:
+            if field.source == '*' or '.' in field.source:
+                raise ImproperlyConfigured('Field %s of %s has no column to compile' % (name, serializer_class.__name__))
+
+        self.serializer_class = serializer_class
+        self.names = tuple(name for name, _ in fields)
+        self.sources = tuple(field.source for _, field in fields)
+        self.to_representation = self.compile([get_converter(field) for _, field in fields])
+
+    def compile(self, converters):
+        namespace = {'OrderedDict': OrderedDict}
+        items = []
+        for position, (name, converter) in enumerate(zip(self.names, converters)):
+            namespace['name_%d' % position] = name
+            if converter is None:
+                items.append('(name_%d, row[%d])' % (position, position))
+            else:
+                namespace['convert_%d' % position] = converter
+                items.append('(name_%d, None if row[%d] is None else convert_%d(row[%d]))'
+                             % (position, position, position, position))
+        source = 'def to_representation(row):\n    return OrderedDict((%s,))\n' % ', '.join(items)
+        exec(source, namespace)
+        return namespace['to_representation']
+
+    def values(self, queryset):
+        return queryset.values_list(*self.sources, named=True)
+
+    def serialize(self, rows):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def compile_serializer(serializer_class):
+    logger.debug("Compiling %s", serializer_class.__name__)
+    return CompiledSerializer(serializer_class)
+
+
+class CompiledListModelMixin:
+    """
+    List a queryset through the compiled form of the view's serializer
+    """
+
+    def list(self, request, *args, **kwargs):
+        compiled = compile_serializer(self.get_serializer_class())
+        queryset = compiled.values(self.filter_queryset(self.get_queryset()))
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(compiled.serialize(page))
+        return Response(compiled.serialize(queryset))
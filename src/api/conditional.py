@@ -0,0 +1,55 @@
+import hashlib
+import logging
+
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+
+from api.cache import get_versions
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ConditionalGetMixin:
+    """
+    Answer GET requests with a strong ETag built from the versions of the tables
+    the response is read from. A matching If-None-Match gets a 304 before
+    authentication, any query or serialization runs.
+    """
+    # Models whose tables the responses are built from
+    etag_models = ()
+    # Keyword arguments of django.utils.cache.patch_cache_control
+    cache_control = None
+
+    def get_etag_models(self):
+        return self.etag_models
+
+    def get_cache_control(self):
+        return self.cache_control if self.cache_control is not None else settings.CATALOG_CACHE_CONTROL
+
+    def get_etag(self, request):
+        tables = [model._meta.db_table for model in self.get_etag_models()]
+        parts = [self.action, request.get_host(), request.get_full_path(), request.META.get('HTTP_ACCEPT', '')]
+        parts += ['%s:%s' % (table, version) for table, version in zip(tables, get_versions(tables))]
+        return quote_etag(hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest())
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+
+        # Set the same way initialize_request() does, which hasn't run yet
+        self.request = request
+        self.action = self.action_map.get(request.method.lower())
+        etag = self.get_etag(request)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            logger.debug("Not modified")
+            response = HttpResponseNotModified()
+        else:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        patch_cache_control(response, **self.get_cache_control())
+        return response
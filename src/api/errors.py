@@ -51,10 +51,15 @@ DEP_02 = Error(code="DEP_02", message="Don'exist department with this ID.", _sta
 
 # Product's Errors
 PRO_01 = Error(code="PRO_01", message="Don't exist product with this ID", _status=404)
+PRO_02 = Error(code="PRO_02", message="The export format is not supported", _status=400, field='output')
+PRO_03 = Error(code="PRO_03", message="The cursor is not a number", _status=400, field='after')
+PRO_04 = Error(code="PRO_04", message="The cursor is invalid", _status=400, field='cursor')
 
 # Order's Errors
 ORD_01 = Error(code="ORD_01", message="Don't exist order with this ID", _status=404)
 ORD_02 = Error(code="ORD_02", message="Don't exist order detail with this ID", _status=404)
+ORD_03 = Error(code="ORD_03", message="Don't exist tax with this ID", _status=404, field='tax_id')
+ORD_04 = Error(code="ORD_04", message="Don't exist shipping with this ID", _status=404, field='shipping_id')
 
 # Commons Errors
 COM_00 = Error(code="COM_00", message="There is something wrong", _status=500)
@@ -63,8 +68,14 @@ COM_02 = Error(code="COM_02", message="Invalid Data", _status=400)
 COM_10 = Error(code="COM_10", message="", _status=400)
 
 
+# Stripe's Errors
+STR_01 = Error(code="STR_01", message="The Stripe signature is invalid", _status=400, field='Stripe-Signature')
+STR_02 = Error(code="STR_02", message="The Stripe webhook secret is not configured", _status=500)
+
 # ShoppingCart's Errors
 SHP_01 = Error(code="ORD_01", message="Don't exist shoppingCart with this cart_id", _status=404)
+SHP_02 = Error(code="SHP_02", message="Don't exist item with this ID", _status=404)
+SHP_03 = Error(code="SHP_03", message="The item was changed by another request", _status=409, field='version')
 
 
 def handle(error: Error):
@@ -0,0 +1,75 @@
+import csv
+import json
+import logging
+from collections import defaultdict
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from api.attributes import resolve_attributes
+from api.models import Product, ProductCategory
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_FIELDS = ('product_id', 'name', 'description', 'price', 'discounted_price', 'image', 'image_2', 'thumbnail',
+                  'display')
+
+
+def iter_chunks(after=0, chunk_size=1000):
+    """
+    Yield the catalog as lists of product dicts, walking the primary key so
+    memory stays bounded by the chunk size. Resume by passing the last
+    product_id already received as `after`.
+    """
+    while True:
+        rows = list(Product.objects.filter(product_id__gt=after).order_by('product_id')
+                    .values_list(*PRODUCT_FIELDS)[:chunk_size])
+        if not rows:
+            return
+
+        product_ids = [row[0] for row in rows]
+        categories = defaultdict(list)
+        for product_id, category_id in ProductCategory.objects.filter(product_id__in=product_ids).values_list(
+                'product_id', 'category_id').order_by('product_id', 'category_id'):
+            categories[product_id].append(category_id)
+        attributes = resolve_attributes(product_ids)
+
+        chunk = []
+        for row in rows:
+            product = dict(zip(PRODUCT_FIELDS, row))
+            product['categories'] = categories.get(row[0], [])
+            product['attributes'] = attributes.get(row[0], [])
+            chunk.append(product)
+        yield chunk
+        after = product_ids[-1]
+
+
+def ndjson(chunks):
+    for chunk in chunks:
+        yield ''.join(json.dumps(product, cls=DjangoJSONEncoder) + '\n' for product in chunk)
+
+
+class Echo:
+    """
+    File-like object handing back what csv.writer writes to it
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_rows(chunks):
+    writer = csv.writer(Echo())
+    yield writer.writerow(PRODUCT_FIELDS + ('categories', 'attributes'))
+    for chunk in chunks:
+        yield ''.join(writer.writerow(
+            [product[field] for field in PRODUCT_FIELDS] +
+            ['|'.join(str(category_id) for category_id in product['categories']),
+             '|'.join('%s:%s' % (attribute['attribute_name'], attribute['attribute_value'])
+                      for attribute in product['attributes'])])
+            for product in chunk)
+
+
+FORMATS = {
+    'ndjson': (ndjson, 'application/x-ndjson'),
+    'csv': (csv_rows, 'text/csv'),
+}
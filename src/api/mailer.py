@@ -0,0 +1,143 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import render_to_string
+
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class EmailQueue:
+    """
+    Sends emails from a background thread so requests never wait on SMTP.
+
+    Jobs are rendered by the worker and sent in batches of up to
+    ORDER_EMAIL_BATCH_SIZE over one SMTP connection, kept open while mails keep
+    coming and closed after ORDER_EMAIL_IDLE_TIMEOUT idle seconds. A failed
+    batch is retried ORDER_EMAIL_RETRIES times with an exponential backoff on a
+    new connection; mails are sent at least once, so a retry after a partial
+    send can repeat some of them.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(settings.ORDER_EMAIL_QUEUE_SIZE)
+        self._worker = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def put(self, subject, template, to, context):
+        """
+        Queue a mail rendered from template.html and template.txt. Returns False
+        when the queue is full and the mail was dropped.
+        """
+        try:
+            self.queue.put_nowait((subject, template, to, context))
+        except queue.Full:
+            logger.error("Email queue is full, dropping '%s' to %s", subject, to)
+            return False
+        self._start()
+        return True
+
+    def join(self):
+        """
+        Wait until every queued mail has been handled
+        """
+        self.queue.join()
+
+    def stop(self, timeout=10):
+        """
+        Send what is still queued and stop the worker
+        """
+        if self._worker is not None and self._worker.is_alive():
+            self.queue.put(_STOP)
+            self._worker.join(timeout)
+
+    def _start(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name='email-queue', daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        connection = None
+        while True:
+            try:
+                batch = [self.queue.get(timeout=settings.ORDER_EMAIL_IDLE_TIMEOUT)]
+            except queue.Empty:
+                connection = self._close(connection)
+                continue
+            while len(batch) < settings.ORDER_EMAIL_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            jobs = [job for job in batch if job is not _STOP]
+            messages = [message for message in map(self._render, jobs) if message is not None]
+            if messages:
+                connection = self._send(messages, connection)
+            for _ in batch:
+                self.queue.task_done()
+            if len(jobs) < len(batch):
+                self._close(connection)
+                return
+
+    @staticmethod
+    def _render(job):
+        subject, template, to, context = job
+        try:
+            message = EmailMultiAlternatives(subject, render_to_string(template + '.txt', context),
+                                             settings.DEFAULT_FROM_EMAIL, [to])
+            message.attach_alternative(render_to_string(template + '.html', context), 'text/html')
+            return message
+        except Exception:
+            logger.exception("Rendering '%s' to %s failed", subject, to)
+            return None
+
+    def _send(self, messages, connection):
+        """
+        Send a batch, returning the connection to reuse for the next one
+        """
+        for attempt in range(settings.ORDER_EMAIL_RETRIES + 1):
+            try:
+                if connection is None:
+                    connection = get_connection()
+                    connection.open()
+                connection.send_messages(messages)
+                logger.debug("Sent %s emails", len(messages))
+                return connection
+            except Exception:
+                logger.exception("Sending %s emails failed (attempt %s)", len(messages), attempt + 1)
+                connection = self._close(connection)
+                if attempt < settings.ORDER_EMAIL_RETRIES:
+                    time.sleep(settings.ORDER_EMAIL_RETRY_DELAY * 2 ** attempt)
+        logger.error("Dropping %s emails to %s", len(messages), ', '.join(m.to[0] for m in messages))
+        return None
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                logger.exception("Closing the SMTP connection failed")
+        return None
+
+
+email_queue = EmailQueue()
+
+
+def send_order_confirmation(order_id, customer):
+    """
+    Queue the notify_order mail of a new order
+    """
+    return email_queue.put('Your order %s' % order_id, 'notify_order', customer.email,
+                           {'order_id': order_id, 'username': customer.name})
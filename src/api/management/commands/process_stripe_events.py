@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.stripe_events import process_pending
+
+
+class Command(BaseCommand):
+    help = 'Apply the stored Stripe webhook events that are due, e.g. after a restart'
+
+    def handle(self, *args, **options):
+        processed = process_pending()
+        self.stdout.write(self.style.SUCCESS('Applied %s Stripe events' % processed))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.cart_store import propagate_prices
+
+
+class Command(BaseCommand):
+    help = 'Update the carts holding some products after a bulk change of their prices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='+', type=int, help='Products whose price changed')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Carts updated per transaction')
+
+    def handle(self, *args, **options):
+        def progress(done, total):
+            self.stdout.write('%s/%s carts updated' % (done, total))
+
+        carts = propagate_prices(options['product_ids'], options['chunk_size'], progress)
+        self.stdout.write(self.style.SUCCESS('Updated %s carts' % carts))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.cart_store import reap_carts
+
+
+class Command(BaseCommand):
+    help = 'Delete the shopping carts idle for longer than CART_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, help='Idle seconds after which a cart is deleted')
+        parser.add_argument('--chunk-size', type=int, help='Rows deleted per statement')
+        parser.add_argument('--pause', type=float, help='Seconds to wait between chunks')
+
+    def handle(self, *args, **options):
+        deleted, seconds = reap_carts(options['ttl'], options['chunk_size'], options['pause'])
+        self.stdout.write(self.style.SUCCESS('Deleted %s cart rows in %.1f seconds' % (deleted, seconds)))
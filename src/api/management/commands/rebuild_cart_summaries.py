@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.cart_store import check_summaries, rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the shopping cart summaries from the shopping_cart table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report the carts whose summary is stale')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Carts handled per statement')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            stale = check_summaries(options['chunk_size'])
+            if stale:
+                raise CommandError('%s cart summaries are stale: %s' % (len(stale), ', '.join(stale[:20])))
+            self.stdout.write(self.style.SUCCESS('Cart summaries are consistent'))
+            return
+        carts = rebuild_summaries(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt summaries of %s carts' % carts))
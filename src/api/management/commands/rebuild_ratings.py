@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product rating summaries from the review table'
+
+    def handle(self, *args, **options):
+        rated = rebuild_ratings()
+        self.stdout.write(self.style.SUCCESS('Rebuilt rating summaries of %s products' % rated))
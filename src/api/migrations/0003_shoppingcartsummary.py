@@ -0,0 +1,25 @@
+# Generated by Django 2.2.2 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_productrating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingCartSummary',
+            fields=[
+                ('cart_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('item_count', models.IntegerField(default=0)),
+                ('subtotal', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+            ],
+            options={
+                'db_table': 'shopping_cart_summary',
+                'managed': False,
+            },
+        ),
+    ]
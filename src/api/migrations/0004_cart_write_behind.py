@@ -0,0 +1,34 @@
+# Generated by Django 2.2.2 on 2026-10-17 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_shoppingcartsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_value', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'id_sequence',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ShoppingCartDirty',
+            fields=[
+                ('cart_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+            ],
+            options={
+                'db_table': 'shopping_cart_dirty',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.2 on 2026-10-17 20:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_cart_write_behind'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('event_id', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('type', models.CharField(max_length=100)),
+                ('payload', models.TextField()),
+                ('received_on', models.DateTimeField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('attempted_on', models.DateTimeField(blank=True, null=True)),
+                ('processed_on', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'stripe_event',
+                'managed': False,
+            },
+        ),
+    ]
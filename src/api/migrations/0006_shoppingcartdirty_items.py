@@ -0,0 +1,19 @@
+# Generated by Django 2.2.2 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_stripe_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcartdirty',
+            name='items',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+    ]
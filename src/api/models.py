@@ -6,6 +6,7 @@
 #   * Remove `managed = False` lines if you wish to allow Django to create, modify, and delete the table
 # Feel free to rename the models, but don't rename db_table values or field names.
 from django.db import models
+from django.db.models.functions import Coalesce, NullIf
 
 
 class Attribute(models.Model):
@@ -82,6 +83,15 @@ class Department(models.Model):
         db_table = 'department'
 
 
+class IdSequence(models.Model):
+    name = models.CharField(primary_key=True, max_length=50)
+    last_value = models.IntegerField(default=0)
+
+    class Meta:
+        managed = False
+        db_table = 'id_sequence'
+
+
 class OrderDetail(models.Model):
     item_id = models.AutoField(primary_key=True)
     order_id = models.IntegerField()
@@ -112,6 +122,11 @@ class Orders(models.Model):
     class Meta:
         managed = False
         db_table = 'orders'
+        # Order history, see sql/database.sql
+        indexes = [
+            models.Index(fields=['customer_id', '-created_on', 'order_id', 'total_amount', 'shipped_on', 'status'],
+                         name='idx_orders_customer_created_on'),
+        ]
 
 
 class Product(models.Model):
@@ -150,6 +165,21 @@ class ProductCategory(models.Model):
         unique_together = (('product_id', 'category_id'),)
 
 
+class ProductRating(models.Model):
+    product_id = models.IntegerField(primary_key=True)
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    rating_1 = models.IntegerField(default=0)
+    rating_2 = models.IntegerField(default=0)
+    rating_3 = models.IntegerField(default=0)
+    rating_4 = models.IntegerField(default=0)
+    rating_5 = models.IntegerField(default=0)
+
+    class Meta:
+        managed = False
+        db_table = 'product_rating'
+
+
 class Review(models.Model):
     review_id = models.AutoField(primary_key=True)
     customer_id = models.IntegerField()
@@ -183,6 +213,33 @@ class ShippingRegion(models.Model):
         db_table = 'shipping_region'
 
 
+class ShoppingCartQuerySet(models.QuerySet):
+    def active(self):
+        """
+        Items to buy now, served by the (cart_id, buy_now) index
+        """
+        return self.filter(buy_now=True)
+
+    def saved(self):
+        """
+        Items saved for later, served by the (cart_id, buy_now) index
+        """
+        return self.filter(buy_now=False)
+
+    def with_products(self):
+        """
+        Annotate the name, image and price (the discounted one when there's one) of the product
+        """
+        product = Product.objects.filter(product_id=models.OuterRef('product_id'))
+        return self.annotate(
+            name=models.Subquery(product.values('name')[:1]),
+            image=models.Subquery(product.values('image')[:1]),
+            price=models.Subquery(product.annotate(
+                sale_price=Coalesce(NullIf('discounted_price', models.Value(0)), 'price')
+            ).values('sale_price')[:1], output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+        ).filter(name__isnull=False)
+
+
 class ShoppingCart(models.Model):
     item_id = models.AutoField(primary_key=True)
     cart_id = models.CharField(max_length=32)
@@ -191,10 +248,60 @@ class ShoppingCart(models.Model):
     quantity = models.IntegerField()
     buy_now = models.IntegerField()
     added_on = models.DateTimeField()
+    version = models.IntegerField(default=0)
+
+    objects = ShoppingCartQuerySet.as_manager()
 
     class Meta:
         managed = False
         db_table = 'shopping_cart'
+        # On MySQL the key is on an MD5 of attributes, see sql/database.sql
+        constraints = [
+            models.UniqueConstraint(fields=['cart_id', 'product_id', 'attributes'],
+                                    name='idx_shopping_cart_cart_id_product_id_attributes'),
+        ]
+        indexes = [
+            # Items to buy or saved for later of a cart, see active() and saved()
+            models.Index(fields=['cart_id', 'buy_now'], name='idx_shopping_cart_cart_buy_now'),
+            # Reverse index from a product to the carts holding it
+            models.Index(fields=['product_id', 'cart_id'], name='idx_shopping_cart_product_cart'),
+        ]
+
+
+class ShoppingCartSummary(models.Model):
+    cart_id = models.CharField(primary_key=True, max_length=32)
+    item_count = models.IntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        managed = False
+        db_table = 'shopping_cart_summary'
+
+
+class ShoppingCartDirty(models.Model):
+    cart_id = models.CharField(primary_key=True, max_length=32)
+    items = models.TextField()
+
+    class Meta:
+        managed = False
+        db_table = 'shopping_cart_dirty'
+
+
+class StripeEvent(models.Model):
+    event_id = models.CharField(primary_key=True, max_length=100)
+    type = models.CharField(max_length=100)
+    payload = models.TextField()
+    received_on = models.DateTimeField()
+    attempts = models.IntegerField(default=0)
+    attempted_on = models.DateTimeField(blank=True, null=True)
+    processed_on = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'stripe_event'
+        indexes = [
+            models.Index(fields=['processed_on', 'received_on'], name='idx_stripe_event_processed_on'),
+        ]
 
 
 class Tax(models.Model):
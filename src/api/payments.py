@@ -1,6 +1,10 @@
 import os
+import threading
 
+import requests
 import stripe
+from requests.adapters import HTTPAdapter
+from stripe import api_requestor, http_client, util
 
 from turing_backend import settings
 import logging
@@ -23,7 +27,7 @@ class PaymentError(Exception):
 def handle_error(function):
     def wrapper(*args, **kwargs):
         try:
-            function(*args, **kwargs)
+            return function(*args, **kwargs)
         except stripe.error.CardError as e:
             # Since it's a decline, stripe.error.CardError will be caught
             body = e.json_body
@@ -65,28 +69,73 @@ def handle_error(function):
     return wrapper
 
 
-@handle_error
-def create(amount, order_id, currency="usd", source="tok_mastercard", description=None):
-    stripe.api_key = settings.STRIPE_API_KEY
+class PaymentClient:
+    """
+    Stripe API client with its own key, API base and keep-alive connection pool,
+    instead of the module-wide stripe.api_key and default HTTP client.
+
+    Requests share one requests.Session holding up to STRIPE_POOL_SIZE open
+    connections, so calls after the first skip the TCP and TLS handshakes. Each
+    call gives up after STRIPE_CONNECT_TIMEOUT seconds to connect or
+    STRIPE_READ_TIMEOUT seconds waiting for the response.
+    """
+
+    def __init__(self, api_key=None, api_base=None, timeout=None, pool_size=None):
+        self.api_key = api_key or settings.STRIPE_API_KEY
+        self.api_base = api_base or settings.STRIPE_API_BASE
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or settings.STRIPE_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.http_client = http_client.RequestsClient(
+            timeout=timeout or (settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+            session=self.session)
+
+    def request(self, method, url, params=None, idempotency_key=None):
+        requestor = api_requestor.APIRequestor(key=self.api_key, client=self.http_client, api_base=self.api_base)
+        response, api_key = requestor.request(method, url, params, util.populate_headers(idempotency_key))
+        return util.convert_to_stripe_object(response, api_key)
+
+    def create_charge(self, amount, order_id, currency="usd", source="tok_mastercard", description=None):
+        return self.request('post', stripe.Charge.class_url(), {
+            'amount': amount,
+            'currency': currency,
+            'source': source,
+            'description': description,
+            'metadata': {'order_id': order_id},
+        })
+
+    def create_webhook_endpoint(self, url, enabled_events):
+        return self.request('post', stripe.WebhookEndpoint.class_url(), {
+            'url': url,
+            'enabled_events': enabled_events,
+        })
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The PaymentClient shared by the process
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PaymentClient()
+    return _client
 
-    response = stripe.Charge.create(
-        amount=amount,
-        currency=currency,
-        source=source,
-        description=description,
-        metadata={'order_id': order_id}
-    )
 
-    return response
+@handle_error
+def create(amount, order_id, currency="usd", source="tok_mastercard", description=None):
+    return get_client().create_charge(amount, order_id, currency=currency, source=source, description=description)
 
 
 @handle_error
 def create_webhook():
-    stripe.api_key = settings.STRIPE_API_KEY
-
-    response = stripe.WebhookEndpoint.create(
-        url=settings.WEBHOOK['url'],
-        enabled_events=settings.WEBHOOK['enabled_events']
-    )
-
-    return response
+    return get_client().create_webhook_endpoint(settings.WEBHOOK['url'], settings.WEBHOOK['enabled_events'])
@@ -0,0 +1,70 @@
+import logging
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from api.cache import bump_version
+from api.models import ProductRating, Review
+
+logger = logging.getLogger(__name__)
+
+STARS = range(1, 6)
+
+
+def record_rating(product_id, rating):
+    """
+    Add a rating to the summary of a product. Call it in the transaction that
+    inserts the review so both commit or roll back together.
+    """
+    star = 'rating_%d' % rating
+    changes = {'review_count': F('review_count') + 1, 'rating_sum': F('rating_sum') + rating, star: F(star) + 1}
+    if not ProductRating.objects.filter(product_id=product_id).update(**changes):
+        try:
+            with transaction.atomic():
+                ProductRating.objects.create(product_id=product_id, review_count=1, rating_sum=rating, **{star: 1})
+        except IntegrityError:
+            # Another review created the summary first
+            ProductRating.objects.filter(product_id=product_id).update(**changes)
+    transaction.on_commit(lambda: bump_version(ProductRating._meta.db_table))
+
+
+def summarize(summary):
+    count = summary.review_count if summary else 0
+    return {
+        'count': count,
+        'average': round(summary.rating_sum / count, 2) if count else None,
+        'stars': {str(star): getattr(summary, 'rating_%d' % star) if summary else 0 for star in STARS},
+    }
+
+
+def get_ratings(product_ids):
+    """
+    Rating summaries of many products with one query
+    """
+    summaries = ProductRating.objects.in_bulk(list(product_ids))
+    return {product_id: summarize(summaries.get(product_id)) for product_id in product_ids}
+
+
+def rebuild_ratings():
+    """
+    Recompute every summary from the review table. Returns the number of products rated.
+    """
+    histograms = defaultdict(dict)
+    for row in Review.objects.values('product_id', 'rating').annotate(total=Count('review_id')).order_by():
+        if row['rating'] in STARS:
+            histograms[row['product_id']][row['rating']] = row['total']
+
+    summaries = [
+        ProductRating(product_id=product_id,
+                      review_count=sum(histogram.values()),
+                      rating_sum=sum(star * total for star, total in histogram.items()),
+                      **{'rating_%d' % star: histogram.get(star, 0) for star in STARS})
+        for product_id, histogram in histograms.items()
+    ]
+    with transaction.atomic():
+        ProductRating.objects.all().delete()
+        ProductRating.objects.bulk_create(summaries, batch_size=1000)
+    bump_version(ProductRating._meta.db_table)
+    logger.debug("Rebuilt %s rating summaries", len(summaries))
+    return len(summaries)
@@ -0,0 +1,136 @@
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from api.cache import get_version, versioned_key
+from api.models import Product
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return [word.lower() for word in WORD_RE.findall(text or '')]
+
+
+class MySQLFullTextSearch:
+    """
+    Search backed by the FULLTEXT index on product(name, description)
+    """
+
+    def search(self, terms, all_words, limit):
+        if all_words:
+            against, mode = ' '.join('+' + term for term in terms), ' IN BOOLEAN MODE'
+        else:
+            against, mode = ' '.join(terms), ''
+        match = 'MATCH (name, description) AGAINST (%s' + mode + ')'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT product_id FROM product WHERE ' + match +
+                ' ORDER BY ' + match + ' DESC, product_id LIMIT %s',
+                [against, against, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexSearch:
+    """
+    In-process inverted index over product name and description, used where
+    the database has no FULLTEXT support. The index is rebuilt whenever the
+    product table version changes.
+    """
+    name_weight = 2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._postings = {}
+        self._documents = 0
+
+    def _build(self):
+        postings = defaultdict(dict)
+        documents = 0
+        for product_id, name, description in Product.objects.values_list(
+                'product_id', 'name', 'description').iterator():
+            documents += 1
+            for term in tokenize(name):
+                postings[term][product_id] = postings[term].get(product_id, 0) + self.name_weight
+            for term in tokenize(description):
+                postings[term][product_id] = postings[term].get(product_id, 0) + 1
+        logger.debug("Search index built with %s products and %s terms", documents, len(postings))
+        return dict(postings), documents
+
+    def _refresh(self):
+        version = get_version(Product._meta.db_table)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._postings, self._documents = self._build()
+                    self._version = version
+        return self._postings, self._documents
+
+    def search(self, terms, all_words, limit):
+        postings, documents = self._refresh()
+        matches = [postings.get(term, {}) for term in terms]
+        if all_words and not all(matches):
+            return []
+        weighted = [(hits, math.log(1 + documents / len(hits))) for hits in matches if hits]
+        if not weighted:
+            return []
+
+        if all_words:
+            # Start from the rarest term and keep the products every other term has
+            weighted.sort(key=lambda item: len(item[0]))
+            hits, idf = weighted[0]
+            scores = {product_id: count * idf for product_id, count in hits.items()}
+            for hits, idf in weighted[1:]:
+                scores = {product_id: score + hits[product_id] * idf
+                          for product_id, score in scores.items() if product_id in hits}
+        else:
+            scores = defaultdict(float)
+            for hits, idf in weighted:
+                for product_id, count in hits.items():
+                    scores[product_id] += count * idf
+        # Only the first limit products are kept, so skip sorting the rest
+        ranked = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, _ in ranked]
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        elif connection.vendor == 'mysql':
+            _backend = MySQLFullTextSearch()
+        else:
+            _backend = InvertedIndexSearch()
+    return _backend
+
+
+def search_products(query_string, all_words=True):
+    """
+    Return the IDs of the products matching the query, most relevant first
+    """
+    terms = sorted(set(tokenize(query_string)))
+    if not terms:
+        return []
+
+    key = versioned_key(Product._meta.db_table, 'search', all_words, *terms)
+    product_ids = cache.get(key)
+    if product_ids is None:
+        product_ids = get_backend().search(terms, all_words, settings.PRODUCT_SEARCH_MAX_RESULTS)
+        cache.set(key, product_ids, settings.CATALOG_CACHE_TIMEOUT)
+    return product_ids
@@ -51,6 +51,12 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ('product_id', 'name', 'description', 'price', 'discounted_price', 'thumbnail')
 
 
+class ProductDetailSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = ('product_id', 'name', 'description', 'price', 'discounted_price', 'image', 'image_2')
+
+
 class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
@@ -63,6 +69,12 @@ class OrdersSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class OrdersShortSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Orders
+        fields = ('order_id', 'total_amount', 'created_on', 'shipped_on', 'status')
+
+
 class OrdersDetailSerializer(serializers.ModelSerializer):
     total_amount = serializers.ReadOnlyField(source='order.total_amount')
     created_on = serializers.ReadOnlyField(source='order.created_on')
@@ -75,6 +87,17 @@ class OrdersDetailSerializer(serializers.ModelSerializer):
         fields = ('order_id', 'total_amount', 'created_on', 'shipped_on', 'status', 'name')
 
 
+class OrderLineSerializer(serializers.ModelSerializer):
+    subtotal = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderDetail
+        fields = ('order_id', 'product_id', 'attributes', 'product_name', 'quantity', 'unit_cost', 'subtotal')
+
+    def get_subtotal(self, obj):
+        return str(obj.unit_cost * obj.quantity)
+
+
 class OrdersSaveSerializer(serializers.ModelSerializer):
     class Meta:
         model = Orders
@@ -87,6 +110,37 @@ class ShoppingcartSerializer(serializers.ModelSerializer):
         fields = ('cart_id', 'attributes', 'product_id', 'quantity')
 
 
+class CartOperationSerializer(serializers.Serializer):
+    """
+    One change of a batch: add takes product_id, attributes and an optional
+    quantity; update takes item_id and quantity; remove, save and move take item_id.
+    Quantities are at least 1, an item is taken out with remove.
+    """
+    action = serializers.ChoiceField(choices=('add', 'update', 'remove', 'save', 'move'))
+    item_id = serializers.IntegerField(required=False)
+    product_id = serializers.IntegerField(required=False)
+    attributes = serializers.CharField(max_length=1000, required=False)
+    quantity = serializers.IntegerField(required=False, min_value=1)
+    version = serializers.IntegerField(required=False, help_text='Only change the item if it is at this version')
+
+    def validate(self, data):
+        if data['action'] == 'add':
+            required = ('product_id', 'attributes')
+        elif data['action'] == 'update':
+            required = ('item_id', 'quantity')
+        else:
+            required = ('item_id',)
+        missing = {field: ['This field is required.'] for field in required if field not in data}
+        if missing:
+            raise serializers.ValidationError(missing)
+        return data
+
+
+class CartBatchSerializer(serializers.Serializer):
+    cart_id = serializers.CharField(max_length=32)
+    operations = CartOperationSerializer(many=True)
+
+
 class TaxSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tax
@@ -98,6 +152,17 @@ class ReviewSerializer(serializers.ModelSerializer):
         model = Review
         fields = ('product_id', 'review', 'customer_id', 'rating')
 
+    def validate_rating(self, value):
+        if not 1 <= value <= 5:
+            raise serializers.ValidationError('The rating must be between 1 and 5')
+        return value
+
+
+class ProductReviewSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Review
+        fields = ('review_id', 'customer_id', 'review', 'rating', 'created_on')
+
 
 class ShippingSerializer(serializers.ModelSerializer):
     class Meta:
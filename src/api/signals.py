@@ -0,0 +1,55 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.cache import bump_version
+from api.catalog_index import record_change
+from api.models import Attribute, AttributeValue, Category, Customer, Department, Product, ProductAttribute, \
+    ProductCategory, Review, ShippingRegion, Tax
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Attribute)
+@receiver(post_delete, sender=Attribute)
+@receiver(post_save, sender=AttributeValue)
+@receiver(post_delete, sender=AttributeValue)
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+@receiver(post_save, sender=Tax)
+@receiver(post_delete, sender=Tax)
+@receiver(post_save, sender=ShippingRegion)
+@receiver(post_delete, sender=ShippingRegion)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def invalidate_table(sender, **kwargs):
+    """
+    Invalidate every cached entry built from the table of the changed row, once
+    the change is committed so no entry is rebuilt from the old rows under the new version
+    """
+    transaction.on_commit(lambda: bump_version(sender._meta.db_table))
+
+
+
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+def publish_membership(sender, instance, created=None, **kwargs):
+    """
+    Invalidate product_category and publish the changed row to the membership
+    indexes once committed. An updated row is published as unknown, which
+    makes the indexes rebuild.
+    """
+    if created is None:
+        # The model is keyed on product_id alone, so deleting a row deletes every row of the product
+        change = (instance.product_id, None, False)
+    elif created:
+        change = (instance.product_id, instance.category_id, True)
+    else:
+        change = None
+    transaction.on_commit(lambda: record_change(change))
@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from api.audit import PAYMENT_FAILED, PAYMENT_SUCCEEDED, audit
+from api.models import Orders, StripeEvent
+from turing_backend import settings
+
+logger = logging.getLogger(__name__)
+
+# Payment statuses of an order; an event only moves an order to a higher one, so
+# late or replayed events can't undo a payment
+STATUS_PAYMENT_FAILED = 1
+STATUS_PAID = 2
+
+# Event type: (order status, audit code, set auth_code)
+EVENT_STATUSES = {
+    'charge.failed': (STATUS_PAYMENT_FAILED, PAYMENT_FAILED, False),
+    'charge.succeeded': (STATUS_PAID, PAYMENT_SUCCEEDED, True),
+}
+
+
+def record(event, payload):
+    """
+    Store a verified event before it is acknowledged. Returns False when it was
+    already received; an event given up on is then retried.
+    """
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(event_id=event['id'], type=event['type'], payload=payload,
+                                       received_on=timezone.now())
+        return True
+    except IntegrityError:
+        StripeEvent.objects.filter(event_id=event['id'], processed_on__isnull=True,
+                                   attempts__gt=settings.STRIPE_EVENT_RETRIES).update(attempts=0, attempted_on=None)
+        return False
+
+
+def handle_event(event):
+    """
+    Apply a charge event to its order and audit it. Safe to run more than once.
+    """
+    if event['type'] not in EVENT_STATUSES:
+        logger.debug("Ignoring event %s of type %s", event['id'], event['type'])
+        return
+    status, code, set_auth_code = EVENT_STATUSES[event['type']]
+    charge = event['data']['object']
+    try:
+        order_id = int((charge.get('metadata') or {})['order_id'])
+    except (KeyError, TypeError, ValueError):
+        logger.error("Event %s has no order_id", event['id'])
+        return
+
+    fields = {'status': status}
+    if set_auth_code:
+        fields['auth_code'] = charge['id']
+    changed = Orders.objects.filter(order_id=order_id, status__lt=status).update(**fields)
+    message = '%s %s (event %s)' % (event['type'], charge['id'], event['id'])
+    audit(order_id, message if changed else message + ', order already past it', code)
+
+
+def is_due(event, now):
+    if event.attempted_on is None:
+        return True
+    delay = settings.STRIPE_EVENT_RETRY_DELAY * 2 ** (event.attempts - 1)
+    return event.attempted_on + timedelta(seconds=delay) <= now
+
+
+def pending_events():
+    """
+    Stored events not applied yet whose next attempt is due, oldest first
+    """
+    now = timezone.now()
+    events = StripeEvent.objects.filter(processed_on__isnull=True, attempts__lte=settings.STRIPE_EVENT_RETRIES)
+    return [event for event in events.order_by('received_on')[:settings.STRIPE_EVENT_BATCH_SIZE]
+            if is_due(event, now)]
+
+
+def process(event):
+    """
+    Claim a stored event and apply it, True when it was applied here. The claim is
+    a conditional UPDATE on attempts, so workers of several processes never run
+    the same attempt.
+    """
+    claimed = StripeEvent.objects.filter(event_id=event.event_id, attempts=event.attempts,
+                                         processed_on__isnull=True)
+    if not claimed.update(attempts=F('attempts') + 1, attempted_on=timezone.now()):
+        return False
+    try:
+        with transaction.atomic():
+            handle_event(json.loads(event.payload))
+            StripeEvent.objects.filter(event_id=event.event_id).update(processed_on=timezone.now())
+        return True
+    except Exception:
+        logger.exception("Handling event %s failed (attempt %s)", event.event_id, event.attempts + 1)
+        if event.attempts >= settings.STRIPE_EVENT_RETRIES:
+            logger.error("Giving up on event %s until Stripe sends it again", event.event_id)
+        return False
+
+
+def process_pending():
+    """
+    Apply the stored events that are due, returning how many were applied
+    """
+    processed = 0
+    events = pending_events()
+    while events:
+        processed += sum(process(event) for event in events)
+        events = pending_events()
+    return processed
+
+
+class EventWorker:
+    """
+    Applies stored webhook events from a background thread, so the webhook can
+    answer Stripe right away. It is woken by each new event and every
+    STRIPE_EVENT_POLL_INTERVAL seconds, for retries and for events left by a
+    process that stopped before applying them.
+    """
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def notify(self):
+        """
+        Have the worker look for stored events
+        """
+        self._wake.set()
+        self._start()
+
+    def stop(self, timeout=10):
+        """
+        Let the worker finish the event at hand and stop it
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._worker is not None and self._worker.is_alive():
+            self._worker.join(timeout)
+
+    def _start(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name='stripe-events', daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.clear()
+            try:
+                process_pending()
+            except Exception:
+                logger.exception("Processing stored Stripe events failed")
+            finally:
+                close_old_connections()
+            self._wake.wait(settings.STRIPE_EVENT_POLL_INTERVAL)
+
+
+event_worker = EventWorker()
@@ -0,0 +1,14 @@
+from django.apps import apps
+from django.test.runner import DiscoverRunner
+
+
+class UnmanagedModelTestRunner(DiscoverRunner):
+    """
+    The api models map tables created by sql/database.sql and are unmanaged.
+    Let the test database be built from them.
+    """
+
+    def setup_databases(self, **kwargs):
+        for model in apps.get_app_config('api').get_models():
+            model._meta.managed = True
+        return super().setup_databases(**kwargs)
@@ -1,3 +1,1618 @@
-from django.test import TestCase
+import csv
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import random
+import socketserver
+import statistics
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db.models import Q
+from django.db import OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import attributes, cart_store, errors, mailer, payments, ratings, search, stripe_events
+from api.audit import ORDER_CREATED, AuditLog
+from api.cart_store import CartOperationError
+from api.catalog_index import MembershipIndex, PRODUCT_CATEGORY, delta_key
+from api.checkout import place_order
+from api.compiled_serializers import compile_serializer
+from api.cache import bump_version, get_version, version_key
+from api.models import Attribute, AttributeValue, Audit, Category, Customer, Department, OrderDetail, Orders, \
+    Product, ProductAttribute, ProductCategory, ProductRating, Review, Shipping, ShoppingCart, ShoppingCartDirty, ShoppingCartSummary, \
+    StripeEvent, Tax
+from api.serializers import DepartmentSerializer, ProductSerializer, TaxSerializer
+from api.viewsets import orders
+from api.viewsets.products import ProductViewSet
+from api.viewsets.orders import create_order
+from turing_backend import settings
+
+benchmark = skipUnless(os.getenv('BENCHMARK'), "set BENCHMARK=1 to run the benchmarks")
+
+
+def measure(function, repeat=20):
+    """
+    Median and 95th percentile of the run time of function, in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def report(name, timings):
+    print('%-50s median %9.2f ms   p95 %9.2f ms' % ((name,) + timings))
+
+
+def make_products(count, words=20000, seed=1):
+    """
+    Insert count products whose names and descriptions draw from a vocabulary
+    with a Zipf-like distribution
+    """
+    rng = random.Random(seed)
+    vocabulary = ['w%s' % rank for rank in range(words)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(words)))
+    batch = []
+    for _ in range(count):
+        name = ' '.join(rng.choices(vocabulary, cum_weights=weights, k=3))
+        description = ' '.join(rng.choices(vocabulary, cum_weights=weights, k=20))
+        batch.append(Product(name=name, description=description, price=Decimal('10.00'),
+                             discounted_price=Decimal('0.00'), display=0))
+        if len(batch) == 5000:
+            Product.objects.bulk_create(batch)
+            batch = []
+    Product.objects.bulk_create(batch)
+
+
+class TableVersionTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_increases_version(self):
+        version = get_version('product')
+        self.assertEqual(bump_version('product'), version + 1)
+        self.assertEqual(get_version('product'), version + 1)
+
+    def test_evicted_version_does_not_come_back(self):
+        seen = {get_version('product')}
+        for _ in range(5):
+            seen.add(bump_version('product'))
+        time.sleep(0.001)
+        cache.delete(version_key('product'))
+        self.assertNotIn(get_version('product'), seen)
+
+        seen.add(get_version('product'))
+        time.sleep(0.001)
+        cache.delete(version_key('product'))
+        self.assertNotIn(bump_version('product'), seen)
+
+
+class TableVersionSignalTest(TransactionTestCase):
+    """
+    Table versions move once a change is committed, never before
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_version_is_bumped_on_commit(self):
+        table = Product._meta.db_table
+        before = get_version(table)
+        with transaction.atomic():
+            product = make_product()
+            self.assertEqual(get_version(table), before)
+        self.assertEqual(get_version(table), before + 1)
+
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            product.delete()
+            raise RuntimeError
+        self.assertEqual(get_version(table), before + 1)
+
+
+class ConditionalGetTest(TransactionTestCase):
+    """
+    Catalog responses carry an ETag that holds until one of their tables changes
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.department = Department.objects.create(name='Regional')
+
+    def test_matching_etag_is_not_modified(self):
+        response = self.client.get('/departments/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('max-age', response['Cache-Control'])
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/departments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotEqual(self.client.get('/departments/%s/' % self.department.department_id)['ETag'], etag)
+
+    def test_write_changes_the_etag(self):
+        etag = self.client.get('/departments/')['ETag']
+        self.department.name = 'Seasonal'
+        self.department.save()
+
+        response = self.client.get('/departments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([department['name'] for department in response.json()], ['Seasonal'])
+        self.assertEqual(self.client.get('/departments/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class InvertedIndexSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ids = {}
+        for name, description in [('red shirt', 'a red shirt'), ('blue shirt', 'blue'),
+                                  ('red hat', 'a hat'), ('scarf', 'red red red')]:
+            product = Product.objects.create(name=name, description=description, price=Decimal('10.00'),
+                                             discounted_price=Decimal('0.00'), display=0)
+            cls.ids[name] = product.product_id
+
+    def search(self, query, all_words=True, limit=10):
+        return search.InvertedIndexSearch().search(search.tokenize(query), all_words, limit)
+
+    def test_all_words(self):
+        self.assertEqual(self.search('red shirt'), [self.ids['red shirt']])
+        self.assertEqual(self.search('red socks'), [])
+
+    def test_any_word_is_ranked_by_weight(self):
+        self.assertEqual(self.search('red shirt', all_words=False),
+                         [self.ids['red shirt'], self.ids['scarf'], self.ids['blue shirt'], self.ids['red hat']])
+        self.assertEqual(self.search('red shirt', all_words=False, limit=2), [self.ids['red shirt'], self.ids['scarf']])
+
+    def test_unknown_word(self):
+        self.assertEqual(self.search('socks', all_words=False), [])
+
+
+class ProductCursorTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [Product.objects.create(name='shirt %s' % i, description='shirt', price=Decimal('10.00'),
+                                               discounted_price=Decimal('0.00'), display=0) for i in range(5)]
+
+    def setUp(self):
+        cache.clear()
+
+    def assertInvalidCursor(self, response):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error']['code'], 'PRO_04')
+
+    def test_invalid_cursor(self):
+        self.assertInvalidCursor(self.client.get('/products/', {'cursor': 'abc'}))
+        self.assertInvalidCursor(self.client.get('/products/search/', {'query_string': 'shirt', 'cursor': '1:x'}))
+        self.assertInvalidCursor(self.client.get('/products/%s/reviews/' % self.products[0].product_id,
+                                                 {'cursor': 'abc'}))
+
+    def test_unknown_product_in_search_cursor(self):
+        self.assertInvalidCursor(self.client.get('/products/search/', {'query_string': 'shirt', 'cursor': 999}))
+
+    def test_search_continues_when_cursor_product_left(self):
+        response = self.client.get('/products/search/', {'query_string': 'shirt', 'cursor': 0, 'limit': 2})
+        first = [row['product_id'] for row in response.json()['results']]
+        next_link = response.json()['next']
+
+        Product.objects.filter(product_id=first[-1]).delete()
+        response = self.client.get(next_link)
+        self.assertEqual(response.status_code, 200)
+        second = [row['product_id'] for row in response.json()['results']]
+        self.assertEqual(second, [product.product_id for product in self.products][2:4])
+
+    def test_list_cursor(self):
+        response = self.client.get('/products/', {'cursor': 0, 'limit': 3})
+        self.assertEqual(len(response.json()['results']), 3)
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([row['product_id'] for row in response.json()['results']],
+                         [product.product_id for product in self.products][3:])
+
+
+class ExportTest(TestCase):
+    """
+    The catalog export streams a chunk at a time and resumes after a product ID
+    """
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(attributes, '_snapshot', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.product_ids = [make_product(name='shirt %s' % i).product_id for i in range(5)]
+        ProductCategory.objects.create(product_id=self.product_ids[0], category_id=7)
+        size = Attribute.objects.create(name='Size')
+        value = AttributeValue.objects.create(attribute_id=size.attribute_id, value='S')
+        ProductAttribute.objects.create(product_id=self.product_ids[0], attribute_value_id=value.attribute_value_id)
+
+    def export(self, **params):
+        with mock.patch.object(settings, 'EXPORT_CHUNK_SIZE', 2):
+            return self.client.get('/products/export/', params)
+
+    def test_ndjson_is_streamed_by_chunk(self):
+        response = self.export()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        chunks = [chunk.decode('utf-8') for chunk in response.streaming_content]
+        self.assertEqual([chunk.count('\n') for chunk in chunks], [2, 2, 1])
+
+        products = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+        self.assertEqual([product['product_id'] for product in products], self.product_ids)
+        self.assertEqual(products[0]['categories'], [7])
+        self.assertEqual(products[0]['attributes'][0]['attribute_value'], 'S')
+        self.assertEqual(products[1]['categories'], [])
+
+    def test_csv(self):
+        response = self.export(output='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(rows[0][0], 'product_id')
+        self.assertEqual(rows[0][-2:], ['categories', 'attributes'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], self.product_ids)
+        self.assertEqual(rows[1][-2:], ['7', 'Size:S'])
+
+    def test_after_resumes(self):
+        response = self.export(after=self.product_ids[2])
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['product_id'] for line in lines], self.product_ids[3:])
+
+    def test_bad_parameters(self):
+        response = self.export(after='abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error']['code'], 'PRO_03')
+        response = self.export(output='xml')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error']['code'], 'PRO_02')
+
+
+class MembershipIndexTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        department = Department.objects.create(name='Regional')
+        self.category = Category.objects.create(department_id=department.department_id, name='French')
+        self.department_id = department.department_id
+        self.product_ids = [make_product().product_id for _ in range(3)]
+
+    def test_changes_are_seen_by_every_copy(self):
+        local, other = MembershipIndex(), MembershipIndex()
+        for index in (local, other):
+            self.assertEqual(list(index.products_in_category(self.category.category_id)), [])
+
+        for product_id in reversed(self.product_ids):
+            ProductCategory.objects.create(product_id=product_id, category_id=self.category.category_id)
+        for index in (local, other):
+            self.assertEqual(list(index.products_in_category(self.category.category_id)), self.product_ids)
+            self.assertEqual(list(index.products_in_department(self.department_id)), self.product_ids)
+
+        ProductCategory.objects.get(product_id=self.product_ids[1]).delete()
+        for index in (local, other):
+            self.assertEqual(list(index.products_in_category(self.category.category_id)),
+                             [self.product_ids[0], self.product_ids[2]])
+            self.assertEqual(list(index.products_in_department(self.department_id)),
+                             [self.product_ids[0], self.product_ids[2]])
+
+    def test_changes_are_applied_without_rebuild(self):
+        index = MembershipIndex()
+        other = Category.objects.create(department_id=self.department_id, name='Italian')
+        index.products_in_category(self.category.category_id)
+
+        with mock.patch.object(index, '_build') as build:
+            ProductCategory.objects.create(product_id=self.product_ids[2], category_id=other.category_id)
+            ProductCategory.objects.create(product_id=self.product_ids[0], category_id=self.category.category_id)
+            self.assertEqual(list(index.products_in_category(self.category.category_id)), [self.product_ids[0]])
+            self.assertEqual(list(index.products_in_department(self.department_id)),
+                             [self.product_ids[0], self.product_ids[2]])
+
+            ProductCategory.objects.get(product_id=self.product_ids[0]).delete()
+            self.assertEqual(list(index.products_in_category(self.category.category_id)), [])
+            self.assertEqual(list(index.products_in_category(other.category_id)), [self.product_ids[2]])
+            self.assertEqual(list(index.products_in_department(self.department_id)), [self.product_ids[2]])
+        build.assert_not_called()
+
+    def test_missing_change_rebuilds(self):
+        index = MembershipIndex()
+        index.products_in_category(self.category.category_id)
+        ProductCategory.objects.create(product_id=self.product_ids[1], category_id=self.category.category_id)
+        cache.delete(delta_key(get_version(PRODUCT_CATEGORY)))
+
+        with mock.patch.object(index, '_build', wraps=index._build) as build:
+            self.assertEqual(list(index.products_in_category(self.category.category_id)), [self.product_ids[1]])
+        build.assert_called_once_with()
+
+    def test_unknown_category(self):
+        self.assertIsNone(MembershipIndex().products_in_category(0))
+
+
+class AttributeSnapshotTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(attributes, '_snapshot', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        size = Attribute.objects.create(name='Size')
+        color = Attribute.objects.create(name='Color')
+        self.small = AttributeValue.objects.create(attribute_id=size.attribute_id, value='S')
+        self.red = AttributeValue.objects.create(attribute_id=color.attribute_id, value='Red')
+        self.product_ids = [make_product().product_id for _ in range(2)]
+
+    def test_products_are_resolved_by_query(self):
+        ProductAttribute.objects.create(product_id=self.product_ids[0], attribute_value_id=self.small.attribute_value_id)
+        attributes.get_snapshot()
+
+        with mock.patch.object(attributes, 'build_snapshot') as build, self.assertNumQueries(1):
+            resolved = attributes.resolve_attributes(self.product_ids)
+        build.assert_not_called()
+        self.assertEqual(resolved, {self.product_ids[0]: [
+            {'attribute_name': 'Size', 'attribute_value_id': self.small.attribute_value_id, 'attribute_value': 'S'}
+        ]})
+
+        ProductAttribute.objects.create(product_id=self.product_ids[1], attribute_value_id=self.red.attribute_value_id)
+        with mock.patch.object(attributes, 'build_snapshot') as build:
+            resolved = attributes.resolve_attributes(self.product_ids)
+        build.assert_not_called()
+        self.assertEqual(resolved[self.product_ids[1]][0]['attribute_value'], 'Red')
+
+    def test_snapshot_follows_value_changes(self):
+        self.assertEqual(attributes.get_snapshot().values[self.red.attribute_value_id][2], 'Red')
+        self.red.value = 'Crimson'
+        self.red.save()
+        self.assertEqual(attributes.get_snapshot().values[self.red.attribute_value_id][2], 'Crimson')
+
+    def test_snapshot_is_built_on_first_use(self):
+        with mock.patch.object(attributes, 'build_snapshot', wraps=attributes.build_snapshot) as build:
+            self.assertEqual(attributes.resolve_attributes([]), {})
+            build.assert_not_called()
+            attributes.get_snapshot()
+        build.assert_called_once_with(mock.ANY)
+
+
+@benchmark
+class SearchBenchmark(TestCase):
+    """
+    Search latency over BENCHMARK_PRODUCTS products, 1M by default
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = int(os.getenv('BENCHMARK_PRODUCTS', 1000000))
+        make_products(cls.products)
+
+    def test_search(self):
+        backend = search.InvertedIndexSearch()
+        start = time.perf_counter()
+        backend.search(['w1'], True, 1)
+        print('\n%s products, index built in %.1fs' % (self.products, time.perf_counter() - start))
+
+        queries = [('common word', 'w1'), ('two common words', 'w1 w2'),
+                   ('common and rare word', 'w1 w5000'), ('two less common words', 'w200 w300')]
+        for name, query in queries:
+            terms = search.tokenize(query)
+            for all_words in (True, False):
+                self.assertTrue(backend.search(terms, all_words, 1000))
+                report('index, %s, all_words=%s' % (name, all_words),
+                       measure(lambda: backend.search(terms, all_words, 1000)))
+
+        for name, query in queries[::3]:
+            def scan():
+                lookup = Q()
+                for term in query.split():
+                    lookup &= Q(name__icontains=term) | Q(description__icontains=term)
+                products = Product.objects.filter(lookup)
+                products.count()
+                list(products.order_by('product_id').values_list('product_id', flat=True)[:20])
+            report('icontains scan, %s' % name, measure(scan, repeat=3))
+
+        response = self.client.get('/products/search/', {'query_string': 'w1 w2'})
+        self.assertEqual(response.status_code, 200)
+        report('endpoint, cached ranking, page 1',
+               measure(lambda: self.client.get('/products/search/', {'query_string': 'w1 w2'})))
+
+
+class CompiledSerializerTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.create(name='shirt', description='blue', price=Decimal('10.5'),
+                               discounted_price=Decimal('0.00'), display=0, thumbnail='shirt.gif')
+        Product.objects.create(name='hat', description='', price=Decimal('7'),
+                               discounted_price=Decimal('6.99'), display=1)
+        Tax.objects.create(tax_type='Sales Tax at 8.5%', tax_percentage=Decimal('8.50'))
+        Department.objects.create(name='Regional')
+
+    def test_same_output_as_serializer(self):
+        for serializer_class in (ProductSerializer, TaxSerializer, DepartmentSerializer):
+            queryset = serializer_class.Meta.model.objects.order_by('pk')
+            compiled = compile_serializer(serializer_class)
+            self.assertEqual(json.dumps(compiled.serialize(compiled.values(queryset))),
+                             json.dumps(serializer_class(queryset, many=True).data))
+
+
+@benchmark
+class SerializerBenchmark(TestCase):
+    """
+    Compiled serializer against ProductSerializer(many=True) for a page of 20 and 200 products
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        make_products(200)
+
+    def test_serializers(self):
+        compiled = compile_serializer(ProductSerializer)
+        products = Product.objects.order_by('product_id')
+        print()
+        for rows in (20, 200):
+            instances = list(products[:rows])
+            values = list(compiled.values(products)[:rows])
+            self.assertEqual(compiled.serialize(values), ProductSerializer(instances, many=True).data)
+            report('%s rows, serializer' % rows, measure(lambda: ProductSerializer(instances, many=True).data, 200))
+            report('%s rows, compiled' % rows, measure(lambda: compiled.serialize(values), 200))
+            report('%s rows, query and serializer' % rows,
+                   measure(lambda: ProductSerializer(products[:rows], many=True).data, 200))
+            report('%s rows, query and compiled' % rows,
+                   measure(lambda: compiled.serialize(compiled.values(products)[:rows]), 200))
+
+
+def make_product(price='10.00', discounted_price='0.00', name='shirt'):
+    return Product.objects.create(name=name, description=name, price=Decimal(price),
+                                  discounted_price=Decimal(discounted_price), display=0)
+
+
+class CacheCartStorageTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product()
+
+    def setUp(self):
+        cache.clear()
+
+    def rows(self, cart_id):
+        return list(ShoppingCart.objects.filter(cart_id=cart_id).order_by('item_id')
+                    .values_list('item_id', 'product_id', 'quantity'))
+
+    def test_item_ids_are_unique_across_processes_and_cache_loss(self):
+        first, second = cart_store.CacheCartStorage(), cart_store.CacheCartStorage()
+        first.add('a', self.product.product_id, 'S')
+        second.add('b', self.product.product_id, 'S')
+        first.flush()
+        cache.clear()
+        third = cart_store.CacheCartStorage()
+        third.add('c', self.product.product_id, 'S')
+        third.flush()
+        item_ids = ShoppingCart.objects.values_list('item_id', flat=True)
+        self.assertEqual(len(set(item_ids)), 3)
+
+    def test_dirty_carts_are_flushed_by_another_process(self):
+        cart_store.CacheCartStorage().add('a', self.product.product_id, 'S', quantity=2)
+        self.assertEqual(self.rows('a'), [])
+        self.assertEqual(cart_store.CacheCartStorage().flush(), 1)
+        self.assertEqual([row[1:] for row in self.rows('a')], [(self.product.product_id, 2)])
+        self.assertFalse(ShoppingCartDirty.objects.exists())
+
+    def test_evicted_cart_is_still_flushed(self):
+        storage = cart_store.CacheCartStorage()
+        storage.add('a', self.product.product_id, 'S', quantity=2)
+        cache.clear()
+        self.assertEqual([item['quantity'] for item in storage.get_items('a')], [2])
+        cache.clear()
+        self.assertEqual(storage.flush(), 1)
+        self.assertEqual([row[1:] for row in self.rows('a')], [(self.product.product_id, 2)])
+        self.assertEqual(storage.get_summary('a'), (2, Decimal('20.00')))
+
+    def test_checkout_writes_an_evicted_cart(self):
+        storage = cart_store.CacheCartStorage()
+        storage.add('a', self.product.product_id, 'S')
+        cache.clear()
+        with storage.checkout('a'):
+            self.assertEqual(len(self.rows('a')), 1)
+        self.assertFalse(ShoppingCartDirty.objects.exists())
+
+    def test_failing_cart_does_not_hold_back_the_others(self):
+        storage = cart_store.CacheCartStorage()
+        storage.add('a', self.product.product_id, 'S')
+        storage.add('c', self.product.product_id, 'S')
+        storage.add('b', self.product.product_id, 'S')
+        items = storage.get_items('b')
+        ShoppingCartDirty.objects.filter(cart_id='b').update(
+            items=cart_store.dump_items([dict(items[0], product_id=None)]))
+
+        with self.assertLogs('api.cart_store', 'ERROR'):
+            self.assertEqual(storage.flush(), 2)
+        self.assertEqual(len(self.rows('a')), 1)
+        self.assertEqual(len(self.rows('c')), 1)
+        self.assertEqual(list(ShoppingCartDirty.objects.values_list('cart_id', flat=True)), ['b'])
+
+    def test_read_does_not_overwrite_a_newer_cart(self):
+        storage = cart_store.CacheCartStorage()
+        storage.add('a', self.product.product_id, 'S')
+        storage.flush()
+        cache.clear()
+        to_item, changed = cart_store.to_item, []
+
+        def read_meanwhile(row):
+            # Another request changes the cart while this read fills the cache from the database
+            if not changed:
+                changed.append(True)
+                storage.add('a', self.product.product_id, 'S')
+            return to_item(row)
+
+        with mock.patch.object(cart_store, 'to_item', read_meanwhile):
+            self.assertEqual([item['quantity'] for item in storage.get_items('a')], [2])
+        self.assertEqual([item['quantity'] for item in storage.get_items('a')], [2])
+        self.assertEqual(storage.get_summary('a'), (2, Decimal('20.00')))
+
+    def test_locked_cart_is_left_for_the_next_flush(self):
+        storage = cart_store.CacheCartStorage()
+        storage.add('a', self.product.product_id, 'S')
+        with storage.lock('a'), mock.patch.object(settings, 'CART_LOCK_TIMEOUT', 0.05):
+            with self.assertLogs('api.cart_store', 'WARNING'):
+                self.assertEqual(storage.flush(), 0)
+        self.assertEqual(self.rows('a'), [])
+        self.assertEqual(storage.flush(), 1)
+        self.assertEqual(len(self.rows('a')), 1)
+
+
+class AddProductsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product()
+
+    def setUp(self):
+        cache.clear()
+        cart_store._storage = None
+
+    def add(self, cart_id, attributes='S'):
+        return self.client.post('/shoppingcart/add', {'cart_id': cart_id, 'product_id': self.product.product_id,
+                                                      'attributes': attributes})
+
+    def test_too_long(self):
+        for response, field in ((self.add('x' * 33), 'cart_id'), (self.add('a', 'x' * 1001), 'attributes')):
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error']['code'], 'USR_07')
+            self.assertEqual(response.json()['error']['field'], field)
+
+    def test_add(self):
+        response = self.add('x' * 32)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['quantity'], 1)
+
+
+class CartBatchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_product()
+
+    def setUp(self):
+        cache.clear()
+        cart_store._storage = None
+
+    def batch(self, *operations):
+        return self.client.post('/shoppingcart/batch', {'cart_id': 'a', 'operations': list(operations)},
+                                content_type='application/json')
+
+    def test_quantity_must_be_positive(self):
+        response = self.batch({'action': 'add', 'product_id': self.product.product_id, 'attributes': 'S',
+                               'quantity': 2})
+        item_id = response.json()['products'][0]['item_id']
+        for operation in ({'action': 'add', 'product_id': self.product.product_id, 'attributes': 'S', 'quantity': -3},
+                          {'action': 'add', 'product_id': self.product.product_id, 'attributes': 'M', 'quantity': 0},
+                          {'action': 'update', 'item_id': item_id, 'quantity': -1},
+                          {'action': 'update', 'item_id': item_id, 'quantity': 0}):
+            response = self.batch(operation)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error']['code'], 'COM_02')
+        self.assertEqual(self.client.get('/shoppingcart/totalAmount/a').json(), {'total_amount': '20.00'})
+
+    def test_batch(self):
+        response = self.batch({'action': 'add', 'product_id': self.product.product_id, 'attributes': 'S'},
+                              {'action': 'add', 'product_id': self.product.product_id, 'attributes': 'S',
+                               'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_amount'], '30.00')
+
+    def test_new_items_are_one_insert(self):
+        storage = cart_store.DatabaseCartStorage()
+        storage.add('a', self.product.product_id, 'S')
+        operations = [{'action': 'add', 'product_id': self.product.product_id, 'attributes': attributes, 'quantity': 2}
+                      for attributes in ('S', 'M', 'L', 'XL')]
+        with CaptureQueriesContext(connection) as queries:
+            items = storage.apply('a', operations)
+        inserts = [query['sql'] for query in queries if 'INSERT INTO shopping_cart (' in query['sql']]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([(item['attributes'], item['quantity']) for item in items],
+                         [('S', 3), ('M', 2), ('L', 2), ('XL', 2)])
+        self.assertEqual(storage.get_summary('a'), (9, Decimal('90.00')))
+
+
+def run_threads(target, count):
+    """
+    Run target(i) in count threads at once, each closing its connection, and
+    return the exceptions they raised
+    """
+    barrier, failures = threading.Barrier(count), []
+
+    def run(i):
+        try:
+            barrier.wait()
+            target(i)
+        except Exception as exc:
+            failures.append(exc)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+
+class DatabaseCartStorageConcurrencyTest(TransactionTestCase):
+
+    def setUp(self):
+        self.product = make_product()
+        self.storage = cart_store.DatabaseCartStorage()
+
+    def test_concurrent_adds_merge_into_one_row(self):
+        self.assertEqual(run_threads(lambda i: self.storage.add('a', self.product.product_id, 'S'), 8), [])
+        self.assertEqual(list(ShoppingCart.objects.values_list('cart_id', 'quantity')), [('a', 8)])
+        self.assertEqual(self.storage.get_summary('a'), (8, Decimal('80.00')))
+
+    def test_batch_add_merges_with_a_row_added_meanwhile(self):
+        apply_operations = cart_store.apply_operations
+
+        def add_meanwhile(*args, **kwargs):
+            # The row another request inserts once the cart has been read
+            items = apply_operations(*args, **kwargs)
+            ShoppingCart.objects.create(cart_id='a', product_id=self.product.product_id, attributes='S', quantity=1,
+                                        buy_now=1, added_on=timezone.now())
+            return items
+
+        with mock.patch.object(cart_store, 'apply_operations', add_meanwhile):
+            items = self.storage.apply('a', [{'action': 'add', 'product_id': self.product.product_id,
+                                              'attributes': 'S', 'quantity': 2}])
+        self.assertEqual([item['quantity'] for item in items], [3])
+        self.assertEqual(self.storage.get_summary('a'), (3, Decimal('30.00')))
+
+
+class CacheCartStorageConcurrencyTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product()
+        self.storage = cart_store.CacheCartStorage()
+
+    def test_concurrent_adds_merge_into_one_row(self):
+        self.assertEqual(run_threads(lambda i: self.storage.add('a', self.product.product_id, 'S'), 8), [])
+        self.assertEqual(self.storage.get_summary('a'), (8, Decimal('80.00')))
+        self.storage.flush()
+        self.assertEqual(list(ShoppingCart.objects.values_list('cart_id', 'quantity')), [('a', 8)])
+        self.assertEqual(cart_store.DatabaseCartStorage().get_summary('a'), (8, Decimal('80.00')))
+
+
+class CartStressTest(TransactionTestCase):
+    """
+    Threads race read-then-conditional-update loops on the same item through the API
+    """
+    storage_class = cart_store.DatabaseCartStorage
+    threads = 8
+    increments = 10
+
+    def setUp(self):
+        cache.clear()
+        self.storage = self.storage_class()
+        product = make_product()
+        self.storage.add('a', product.product_id, 'S')
+        self.item_id = self.storage.get_items('a')[0]['item_id']
+
+    def increment(self, client):
+        """
+        Add one to the quantity of the item, returning the number of conflicts met
+        """
+        conflicts = 0
+        while True:
+            item = client.get('/shoppingcart/a').json()[0]
+            response = client.put('/shoppingcart/update/%s' % self.item_id, json.dumps(
+                {'quantity': item['quantity'] + 1, 'version': item['version']}), content_type='application/json')
+            if response.status_code == 200:
+                return conflicts
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['error']['code'], 'SHP_03')
+            conflicts += 1
+
+    def test_no_increment_is_lost(self):
+        conflicts = []
+
+        def run(_):
+            client = self.client_class()
+            conflicts.extend(self.increment(client) for _ in range(self.increments))
+
+        with mock.patch.object(cart_store, '_storage', self.storage):
+            self.assertEqual(run_threads(run, self.threads), [])
+        self.storage.flush()
+        item = cart_store.DatabaseCartStorage().get_item(self.item_id)
+        self.assertEqual(item['quantity'], 1 + self.threads * self.increments)
+        self.assertEqual(item['version'], self.threads * self.increments)
+        self.assertEqual(len(conflicts), self.threads * self.increments)
+
+
+class CacheCartStressTest(CartStressTest):
+    storage_class = cart_store.CacheCartStorage
+
+
+class ReapCartsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product()
+        self.storage = cart_store.CacheCartStorage()
+        old = timezone.now() - timedelta(days=30)
+        for cart_id in ('idle', 'dirty', 'recent'):
+            ShoppingCart.objects.create(cart_id=cart_id, product_id=self.product.product_id, attributes='S',
+                                        quantity=1, buy_now=1, added_on=old)
+        ShoppingCart.objects.create(cart_id='recent', product_id=self.product.product_id, attributes='M',
+                                    quantity=1, buy_now=1, added_on=timezone.now())
+
+    def reap(self):
+        with mock.patch.object(cart_store, '_storage', self.storage):
+            return cart_store.reap_carts(ttl=60 * 60 * 24, pause=0)[0]
+
+    def test_unflushed_carts_are_kept(self):
+        # Changed in the cache, its rows still have the old added_on
+        self.storage.get_items('idle')
+        item = self.storage.get_items('dirty')[0]
+        self.storage.update_quantity(item['item_id'], 5)
+
+        self.assertEqual(self.reap(), 1)
+        self.assertEqual(sorted(set(ShoppingCart.objects.values_list('cart_id', flat=True))), ['dirty', 'recent'])
+        self.assertEqual(self.storage.get_items('idle'), [])
+        self.assertEqual(self.storage.get_items('dirty')[0]['quantity'], 5)
+
+        self.storage.flush()
+        self.assertEqual(ShoppingCart.objects.get(cart_id='dirty').quantity, 5)
+        self.assertEqual(self.reap(), 0)
+
+    def test_locked_carts_are_kept(self):
+        with self.storage.lock('idle'), mock.patch.object(settings, 'CART_LOCK_TIMEOUT', 0.05):
+            self.assertEqual(self.reap(), 1)
+        self.assertEqual(sorted(set(ShoppingCart.objects.values_list('cart_id', flat=True))), ['idle', 'recent'])
+
+
+class DatabaseCartSummaryTest(TestCase):
+    """
+    The summary of a cart stays equal to what its rows add up to
+    """
+    storage_class = cart_store.DatabaseCartStorage
+
+    def setUp(self):
+        cache.clear()
+        self.storage = self.storage_class()
+        self.shirt = make_product('10.00')
+        self.hat = make_product('20.00', '15.00', name='hat')
+
+    def assertSummary(self, item_count, subtotal, cart_id='a'):
+        self.storage.flush()
+        self.assertEqual(cart_store.check_summaries(), [])
+        summary = (item_count, Decimal(subtotal))
+        self.assertEqual(self.storage.get_summary(cart_id), summary)
+        self.assertEqual(cart_store.summarize(self.storage.get_items(cart_id)), summary)
+        self.assertEqual(cart_store.DatabaseCartStorage().get_summary(cart_id), summary)
+
+    def item_id(self, product):
+        return next(item['item_id'] for item in self.storage.get_items('a') if item['product_id'] == product.product_id)
+
+    def test_every_change_keeps_the_summary(self):
+        self.storage.add('a', self.shirt.product_id, 'S')
+        self.assertSummary(1, '10.00')
+        self.storage.add('a', self.shirt.product_id, 'S', quantity=2)
+        self.assertSummary(3, '30.00')
+        self.storage.apply('a', [{'action': 'add', 'product_id': self.hat.product_id, 'attributes': 'M',
+                                  'quantity': 2}])
+        self.assertSummary(5, '60.00')
+        self.storage.update_quantity(self.item_id(self.shirt), 1)
+        self.assertSummary(3, '40.00')
+        self.storage.move(self.item_id(self.hat), False)
+        self.assertSummary(1, '10.00')
+        self.storage.move(self.item_id(self.hat), True)
+        self.assertSummary(2, '25.00')
+        self.storage.remove(self.item_id(self.shirt))
+        self.assertSummary(1, '15.00')
+        self.storage.empty('a')
+        self.assertSummary(0, '0.00')
+
+    def test_price_change_is_propagated(self):
+        self.storage.add('a', self.shirt.product_id, 'S', quantity=2)
+        self.storage.add('b', self.hat.product_id, 'S')
+        self.storage.flush()
+        Product.objects.filter(product_id=self.shirt.product_id).update(discounted_price=Decimal('8.00'))
+        self.assertEqual(cart_store.check_summaries(), ['a'])
+        self.assertEqual(cart_store.propagate_prices([self.shirt.product_id]), 1)
+        self.assertSummary(2, '16.00')
+        self.assertSummary(1, '15.00', cart_id='b')
+
+    def test_rebuild(self):
+        self.storage.add('a', self.shirt.product_id, 'S')
+        self.storage.add('b', self.hat.product_id, 'S')
+        self.storage.flush()
+        ShoppingCartSummary.objects.filter(cart_id='a').update(subtotal=Decimal('1.00'))
+        ShoppingCartSummary.objects.create(cart_id='gone', item_count=1, subtotal=Decimal('5.00'))
+
+        self.assertEqual(sorted(cart_store.check_summaries()), ['a', 'gone'])
+        with self.assertRaises(CommandError):
+            call_command('rebuild_cart_summaries', '--check', stdout=io.StringIO())
+        call_command('rebuild_cart_summaries', stdout=io.StringIO())
+        self.assertEqual(cart_store.check_summaries(), [])
+        self.assertSummary(1, '10.00')
+
+
+class CacheCartSummaryTest(DatabaseCartSummaryTest):
+    storage_class = cart_store.CacheCartStorage
+
+
+class CartIndexTest(TestCase):
+    """
+    Cart queries are served by the indexes declared on ShoppingCart
+    """
+
+    def setUp(self):
+        now = timezone.now()
+        self.product_ids = [make_product().product_id for _ in range(20)]
+        ShoppingCart.objects.bulk_create(
+            ShoppingCart(cart_id='cart%s' % (i % 50), product_id=self.product_ids[i % 20], attributes=str(i),
+                         quantity=1, buy_now=i % 3 != 0, added_on=now)
+            for i in range(1000))
+        with connection.cursor() as db_cursor:
+            db_cursor.execute('ANALYZE')
+
+    def plan(self, queries):
+        with connection.cursor() as db_cursor:
+            db_cursor.execute('EXPLAIN QUERY PLAN ' + queries.captured_queries[-1]['sql'])
+            return ' '.join(row[-1] for row in db_cursor.fetchall())
+
+    def test_carts_of_products_use_the_product_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(next(cart_store.carts_with_products(self.product_ids[1:3], 100))), 10)
+        self.assertIn('USING COVERING INDEX idx_shopping_cart_product_cart', self.plan(queries))
+
+    def test_summary_is_computed_from_the_buy_now_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            cart_store.refresh_summaries(['cart1'])
+        self.assertIn('USING INDEX idx_shopping_cart_cart_buy_now', self.plan(queries))
+
+        count = ShoppingCart.objects.filter(cart_id='cart1', buy_now=True).count()
+        with self.assertNumQueries(1):
+            summary = cart_store.DatabaseCartStorage().get_summary('cart1')
+        self.assertEqual(summary, (count, Decimal('10.00') * count))
+
+    def test_saved_items_use_the_buy_now_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            items = cart_store.DatabaseCartStorage().get_products('cart1', buy_now=False)
+        self.assertEqual(len(items), ShoppingCart.objects.filter(cart_id='cart1', buy_now=False).count())
+        self.assertIn('USING INDEX idx_shopping_cart_cart_buy_now (cart_id=? AND buy_now=?)', self.plan(queries))
+
+
+class CartQueryCountTest(TestCase):
+    """
+    Reading a cart partition is a single query with the database storage
+    """
+
+    def setUp(self):
+        self.storage = cart_store.DatabaseCartStorage()
+        self.shirt = make_product('10.00')
+        self.hat = make_product('20.00', '15.00', name='hat')
+        self.storage.add('a', self.shirt.product_id, 'S', quantity=2)
+        self.storage.add('a', self.hat.product_id, 'M')
+        self.hat_item = next(item['item_id'] for item in self.storage.get_items('a')
+                             if item['product_id'] == self.hat.product_id)
+        self.storage.move(self.hat_item, False)
+
+    def test_cart_is_one_query(self):
+        with mock.patch.object(cart_store, '_storage', self.storage), self.assertNumQueries(1):
+            response = self.client.get('/shoppingcart/a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in response.json()], ['shirt'])
+        self.assertEqual(Decimal(response.json()[0]['subtotal']), Decimal('20.00'))
+
+    def test_saved_is_one_query(self):
+        with mock.patch.object(cart_store, '_storage', self.storage), self.assertNumQueries(1):
+            response = self.client.get('/shoppingcart/getSaved/a')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['item_id'] for item in response.json()], [self.hat_item])
+
+    def test_move_is_one_update(self):
+        with mock.patch.object(cart_store, '_storage', self.storage), CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/shoppingcart/moveToCart/%s' % self.hat_item)
+        self.assertEqual(response.status_code, 200)
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(statements[0].startswith('UPDATE "shopping_cart"'))
+        self.assertTrue(statements[1].startswith('DELETE FROM shopping_cart_summary'))
+        self.assertTrue(statements[2].startswith('INSERT INTO shopping_cart_summary'))
+        self.assertEqual(self.storage.get_summary('a'), (3, Decimal('35.00')))
+
+    def statements(self, change):
+        with CaptureQueriesContext(connection) as queries:
+            change()
+        return [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+
+    def test_changes_start_with_the_conditional_statement(self):
+        shirt_item = next(item for item in self.storage.get_items('a') if item['product_id'] == self.shirt.product_id)
+        statements = self.statements(lambda: self.assertEqual(
+            self.storage.update_quantity(shirt_item['item_id'], 3, version=shirt_item['version']), 'a'))
+        self.assertTrue(statements[0].startswith('UPDATE "shopping_cart"'))
+        self.assertEqual(self.storage.get_summary('a'), (3, Decimal('30.00')))
+
+        statements = self.statements(lambda: self.assertTrue(self.storage.remove(shirt_item['item_id'])))
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(statements[0].startswith('DELETE FROM shopping_cart_summary'))
+        self.assertTrue(statements[1].startswith('INSERT INTO shopping_cart_summary'))
+        self.assertTrue(statements[2].startswith('DELETE FROM "shopping_cart"'))
+        self.assertEqual(self.storage.get_summary('a'), (0, Decimal('0.00')))
+
+    def test_conflicting_remove_keeps_the_summary(self):
+        with self.assertRaises(CartOperationError):
+            self.storage.remove(self.hat_item, version=0)
+        self.assertFalse(self.storage.remove(0))
+        self.storage.move(self.hat_item, True)
+        with self.assertRaises(CartOperationError):
+            self.storage.update_quantity(self.hat_item, 0, version=0)
+        self.assertEqual(self.storage.get_summary('a'), (3, Decimal('35.00')))
+        self.assertEqual(cart_store.check_summaries(), [])
+
+
+class CheckoutTest(TestCase):
+    """
+    An order is created with the same statements whatever the size of the cart
+    """
+    storage_class = cart_store.DatabaseCartStorage
+
+    @classmethod
+    def setUpTestData(cls):
+        make_products(100)
+        cls.product_ids = list(Product.objects.order_by('product_id').values_list('product_id', flat=True))
+        cls.tax = Tax.objects.create(tax_type='Sales Tax at 10%', tax_percentage=Decimal('10.00'))
+        cls.shipping = Shipping.objects.create(shipping_type='Standard', shipping_cost=Decimal('5.00'),
+                                               shipping_region_id=2)
+
+    def setUp(self):
+        cache.clear()
+        self.storage = self.storage_class()
+
+    def fill(self, cart_id, items):
+        self.storage.apply(cart_id, [{'action': 'add', 'product_id': product_id, 'attributes': 'S', 'quantity': 2}
+                                     for product_id in self.product_ids[:items]])
+
+    def checkout(self, cart_id):
+        with mock.patch.object(cart_store, '_storage', self.storage):
+            return place_order(cart_id, 1, self.shipping.shipping_id, self.tax.tax_id)
+
+    def test_order_from_cart(self):
+        self.fill('a', 3)
+        order_id = self.checkout('a')
+        self.assertEqual(Orders.objects.get(order_id=order_id).total_amount, Decimal('71.00'))
+        self.assertEqual(OrderDetail.objects.filter(order_id=order_id).count(), 3)
+        self.assertEqual(self.storage.get_items('a'), [])
+        self.assertEqual(self.storage.get_summary('a'), (0, Decimal('0.00')))
+        self.assertFalse(ShoppingCart.objects.filter(cart_id='a').exists())
+
+    def test_queries_do_not_grow_with_the_cart(self):
+        counts = []
+        for items in (1, 100):
+            self.fill('cart%s' % items, items)
+            with CaptureQueriesContext(connection) as queries:
+                self.checkout('cart%s' % items)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_empty_cart(self):
+        with self.assertRaises(CartOperationError) as context:
+            self.checkout('empty')
+        self.assertIs(context.exception.error, errors.SHP_01)
+
+
+class CacheCheckoutTest(CheckoutTest):
+    storage_class = cart_store.CacheCartStorage
+
+
+@benchmark
+class CheckoutBenchmark(CheckoutTest):
+    """
+    Checkout latency of carts of 1, 10 and 100 items with both storages
+    """
+
+    def test_checkout(self):
+        print()
+        for storage_class in (cart_store.DatabaseCartStorage, cart_store.CacheCartStorage):
+            self.storage = storage_class()
+            for items in (1, 10, 100):
+                timings = []
+                for run in range(20):
+                    cart_id = '%s-%s-%s' % (storage_class.__name__, items, run)
+                    self.fill(cart_id, items)
+                    start = time.perf_counter()
+                    self.checkout(cart_id)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                report('%s, %s items' % (storage_class.__name__, items),
+                       (statistics.median(timings), timings[int(len(timings) * 0.95) - 1]))
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """
+    Just enough of an SMTP server on a free local port to count connections and
+    keep the recipients of each message. The first `failures` messages are
+    refused with a 451, and each connection waits `greeting_delay` seconds
+    before greeting.
+    """
+    daemon_threads = True
+
+    def __init__(self, failures=0, greeting_delay=0):
+        super().__init__(('127.0.0.1', 0), SMTPStandInHandler)
+        self.failures = failures
+        self.greeting_delay = greeting_delay
+        self.connections = 0
+        self.recipients = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    def email_settings(self):
+        return override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                 EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server_address[1], EMAIL_HOST_USER='',
+                                 EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        time.sleep(server.greeting_delay)
+        self.reply('220 stand-in')
+        recipients = []
+        for line in self.rfile:
+            command, _, argument = line.decode().strip().partition(' ')
+            command = command.upper()
+            if command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'RCPT':
+                recipients.append(argument.partition(':')[2].strip('<>'))
+            if command != 'DATA':
+                self.reply('250 ok')
+                continue
+            self.reply('354 go ahead')
+            for data in self.rfile:
+                if data in (b'.\r\n', b''):
+                    break
+            with server.lock:
+                refused = server.failures > 0
+                if refused:
+                    server.failures -= 1
+                else:
+                    server.recipients.append(recipients)
+            self.reply('451 try again later' if refused else '250 queued')
+            recipients = []
+
+
+class EmailQueueTest(TestCase):
+    """
+    Order emails through EmailQueue against a local SMTP stand-in
+    """
+
+    def setUp(self):
+        self.email_queue = mailer.EmailQueue()
+        patches = [mock.patch.object(settings, 'ORDER_EMAIL_RETRY_DELAY', 0),
+                   mock.patch.object(settings, 'ORDER_EMAIL_IDLE_TIMEOUT', 5),
+                   mock.patch.object(mailer, 'email_queue', self.email_queue)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def serve(self, **kwargs):
+        server = SMTPStandIn(**kwargs)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        email_settings = server.email_settings()
+        email_settings.enable()
+        self.addCleanup(email_settings.disable)
+        self.addCleanup(self.email_queue.stop)
+        return server
+
+    def put(self, to):
+        return self.email_queue.put('Your order 1', 'notify_order', to, {'order_id': 1, 'username': 'Jo'})
+
+    def test_batches_share_a_connection(self):
+        server = self.serve()
+        addresses = ['customer%s@example.com' % i for i in range(5)]
+        for address in addresses:
+            self.assertTrue(self.put(address))
+        self.email_queue.join()
+        self.assertTrue(self.put('late@example.com'))
+        self.email_queue.join()
+        self.assertEqual(server.recipients, [[address] for address in addresses + ['late@example.com']])
+        self.assertEqual(server.connections, 1)
+
+    def test_idle_connection_is_closed(self):
+        server = self.serve()
+        with mock.patch.object(settings, 'ORDER_EMAIL_IDLE_TIMEOUT', 0.05):
+            self.put('first@example.com')
+            self.email_queue.join()
+            time.sleep(0.2)
+            self.put('second@example.com')
+            self.email_queue.join()
+        self.assertEqual(server.recipients, [['first@example.com'], ['second@example.com']])
+        self.assertEqual(server.connections, 2)
+
+    def test_failed_batch_is_retried_on_a_new_connection(self):
+        server = self.serve(failures=1)
+        self.put('customer@example.com')
+        self.email_queue.join()
+        self.assertEqual(server.recipients, [['customer@example.com']])
+        self.assertEqual(server.connections, 2)
+
+    def test_batch_is_dropped_after_the_retries(self):
+        server = self.serve(failures=10)
+        with mock.patch.object(settings, 'ORDER_EMAIL_RETRIES', 2):
+            self.put('customer@example.com')
+            self.email_queue.join()
+        self.assertEqual(server.recipients, [])
+        self.assertEqual(server.connections, 3)
+
+    def test_order_creation_does_not_wait_for_smtp(self):
+        server = self.serve(greeting_delay=1)
+        tax = Tax.objects.create(tax_type='Sales Tax at 10%', tax_percentage=Decimal('10.00'))
+        shipping = Shipping.objects.create(shipping_type='Standard', shipping_cost=Decimal('5.00'),
+                                           shipping_region_id=2)
+        storage = cart_store.DatabaseCartStorage()
+        storage.add('a', make_product().product_id, 'S')
+        request = APIRequestFactory().post('/orders', {'cart_id': 'a', 'shipping_id': shipping.shipping_id,
+                                                       'tax_id': tax.tax_id}, format='json')
+        customer = Customer(customer_id=1, name='Jo', email='jo@example.com', shipping_region_id=1)
+        force_authenticate(request, user=mock.Mock(customer=customer))
+
+        start = time.perf_counter()
+        with mock.patch.object(cart_store, '_storage', storage), mock.patch.object(orders, 'audit'):
+            response = create_order(request)
+        self.assertLess(time.perf_counter() - start, server.greeting_delay / 2)
+        self.assertEqual(response.status_code, 200)
+        self.email_queue.join()
+        self.assertEqual(server.recipients, [['jo@example.com']])
+
+
+class CustomerOrdersTest(TestCase):
+    """
+    A customer's orders are paged by keyset on idx_orders_customer_created_on
+    """
+
+    def setUp(self):
+        start = timezone.now() - timedelta(days=1)
+        Orders.objects.bulk_create(
+            Orders(total_amount=Decimal('10.00'), created_on=start + timedelta(minutes=i), status=0,
+                   customer_id=1 + i % 2)
+            for i in range(10))
+
+    def get(self, params):
+        request = APIRequestFactory().get('/orders/inCustomer', params)
+        force_authenticate(request, user=mock.Mock(customer=Customer(customer_id=1)))
+        return orders.orders(request).data
+
+    def test_pages(self):
+        seen, params = [], {'limit': 2}
+        while True:
+            page = self.get(params)
+            seen.extend(page['results'])
+            if not page['next']:
+                break
+            params = parse_qs(urlparse(page['next']).query)
+        expected = list(Orders.objects.filter(customer_id=1).order_by('-created_on')
+                        .values_list('order_id', flat=True))
+        self.assertEqual([order['order_id'] for order in seen], expected)
+        self.assertEqual(set(seen[0]), {'order_id', 'total_amount', 'created_on', 'shipped_on', 'status'})
+
+    def test_page_query_uses_the_covering_index(self):
+        params = parse_qs(urlparse(self.get({'limit': 2})['next']).query)
+        with CaptureQueriesContext(connection) as queries:
+            self.get(params)
+        page_query = next(query['sql'] for query in queries if 'FROM "orders"' in query['sql'])
+        with connection.cursor() as db_cursor:
+            db_cursor.execute('EXPLAIN QUERY PLAN ' + page_query)
+            plan = ' '.join(row[-1] for row in db_cursor.fetchall())
+        self.assertIn('USING COVERING INDEX idx_orders_customer_created_on', plan)
+        self.assertIn('created_on<?', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class OrderViewQueryTest(TestCase):
+    """
+    An order and its lines are read with two queries, however many lines it has
+    """
+
+    def setUp(self):
+        self.order = Orders.objects.create(total_amount=Decimal('35.00'), created_on=timezone.now(), status=0,
+                                           customer_id=1)
+        OrderDetail.objects.bulk_create(
+            OrderDetail(order_id=self.order.order_id, product_id=i, attributes='S', product_name='shirt %s' % i,
+                        quantity=i, unit_cost=Decimal('5.00'))
+            for i in range(1, 4))
+
+    def get(self, view, customer_id=1):
+        request = APIRequestFactory().get('/orders/%s' % self.order.order_id)
+        force_authenticate(request, user=mock.Mock(customer=Customer(customer_id=customer_id)))
+        return view(request, order_id=self.order.order_id)
+
+    def test_order_is_two_queries(self):
+        with self.assertNumQueries(2):
+            response = self.get(orders.order)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([line['subtotal'] for line in response.data], ['5.00', '10.00', '15.00'])
+
+    def test_order_details_is_two_queries(self):
+        with self.assertNumQueries(2):
+            response = self.get(orders.order_details)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(line['name'], line['total_amount']) for line in response.data],
+                         [('shirt %s' % i, Decimal('35.00')) for i in range(1, 4)])
+
+    def test_order_of_another_customer(self):
+        for view in (orders.order, orders.order_details):
+            with self.assertNumQueries(1):
+                response = self.get(view, customer_id=2)
+            self.assertEqual(response.status_code, 404)
+
+
+class AuditLogTest(TransactionTestCase):
+    """
+    Audit rows survive a slow or failing database; only rows it refuses are dropped
+    """
+
+    def setUp(self):
+        patches = [mock.patch.object(settings, 'AUDIT_RETRY_DELAY', 0),
+                   mock.patch.object(settings, 'AUDIT_BUFFER_SIZE', 2)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.audit_log = AuditLog()
+
+    def entry(self, message='Order created'):
+        return Audit(order_id=1, created_on=timezone.now(), message=message, code=ORDER_CREATED)
+
+    def test_refused_row_is_dropped_alone(self):
+        self.audit_log._flush([self.entry('first'), self.entry(None), self.entry('last')])
+        self.assertEqual(list(Audit.objects.order_by('audit_id').values_list('message', flat=True)),
+                         ['first', 'last'])
+        self.assertEqual((self.audit_log.written, self.audit_log.dropped), (2, 1))
+
+    def test_transient_errors_are_retried_until_written(self):
+        create = Audit.objects.bulk_create
+        failures = iter([OperationalError('lock wait timeout')] * 20)
+
+        def bulk_create(entries):
+            error = next(failures, None)
+            if error:
+                raise error
+            return create(entries)
+
+        with mock.patch.object(Audit.objects, 'bulk_create', bulk_create):
+            self.audit_log._flush([self.entry(), self.entry()])
+        self.assertEqual(Audit.objects.count(), 2)
+        self.assertEqual((self.audit_log.written, self.audit_log.failures, self.audit_log.dropped), (2, 20, 0))
+
+    def test_full_buffer_blocks_the_caller(self):
+        with mock.patch.object(self.audit_log, '_start'):
+            for _ in range(settings.AUDIT_BUFFER_SIZE):
+                self.audit_log.write(1, 'Order created', ORDER_CREATED)
+            writer = threading.Thread(target=self.audit_log.write, args=(1, 'Order created', ORDER_CREATED))
+            writer.start()
+            writer.join(0.1)
+            self.assertTrue(writer.is_alive())
+
+            self.audit_log.queue.get()
+            self.audit_log.queue.task_done()
+            writer.join(1)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(self.audit_log.stats()['depth'], settings.AUDIT_BUFFER_SIZE)
+        self.assertEqual((self.audit_log.blocked, self.audit_log.dropped), (1, 0))
+
+
+def stripe_signature(payload, secret, timestamp=None):
+    """
+    Stripe-Signature header of a payload, signed like Stripe does
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), ('%s.%s' % (timestamp, payload)).encode(), hashlib.sha256).hexdigest()
+    return 't=%s,v1=%s' % (timestamp, signature)
+
+
+class RatingTest(TestCase):
+    """
+    Rating summaries follow the reviews, and reviews are paged by keyset
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product()
+
+    def post_review(self, rating):
+        request = APIRequestFactory().post('/products/%s/review' % self.product.product_id,
+                                           {'review': 'Nice', 'rating': rating}, format='json')
+        force_authenticate(request, user=mock.Mock(customer=Customer(customer_id=1)))
+        return ProductViewSet.as_view({'post': 'review'})(request, pk=self.product.product_id)
+
+    def test_review_updates_the_summary(self):
+        for rating in (5, 3, 5):
+            self.assertEqual(self.post_review(rating).status_code, 201)
+        self.assertEqual(self.post_review(6).status_code, 400)
+        self.assertEqual(ratings.get_ratings([self.product.product_id])[self.product.product_id],
+                         {'count': 3, 'average': 4.33, 'stars': {'1': 0, '2': 0, '3': 1, '4': 0, '5': 2}})
+
+    def test_review_and_summary_commit_together(self):
+        with mock.patch.object(ratings, 'record_rating', side_effect=OperationalError), \
+                self.assertRaises(OperationalError):
+            self.post_review(4)
+        self.assertFalse(Review.objects.exists())
+        self.assertFalse(ProductRating.objects.exists())
+
+    def test_rebuild(self):
+        now = timezone.now()
+        Review.objects.bulk_create(Review(customer_id=1, product_id=self.product.product_id, review='', rating=rating,
+                                          created_on=now) for rating in (1, 4, 4, 9))
+        ProductRating.objects.create(product_id=0, review_count=1, rating_sum=5, rating_5=1)
+
+        call_command('rebuild_ratings', stdout=io.StringIO())
+        self.assertEqual(list(ProductRating.objects.values_list('product_id', flat=True)), [self.product.product_id])
+        self.assertEqual(ratings.get_ratings([self.product.product_id])[self.product.product_id],
+                         {'count': 3, 'average': 3.0, 'stars': {'1': 1, '2': 0, '3': 0, '4': 2, '5': 0}})
+
+    def test_reviews_are_paged_by_keyset(self):
+        now = timezone.now()
+        Review.objects.bulk_create(Review(customer_id=1, product_id=self.product.product_id, review=str(i), rating=3,
+                                          created_on=now - timedelta(minutes=i)) for i in range(5))
+        expected = list(Review.objects.order_by('-created_on', '-review_id').values_list('review_id', flat=True))
+
+        url = '/products/%s/reviews/' % self.product.product_id
+        page = self.client.get(url, {'limit': 2}).json()
+        seen = [review['review_id'] for review in page['results']]
+        # A review posted meanwhile neither shifts nor repeats the next pages
+        Review.objects.create(customer_id=1, product_id=self.product.product_id, review='new', rating=3,
+                              created_on=now + timedelta(minutes=1))
+        while page['next']:
+            with CaptureQueriesContext(connection) as queries:
+                page = self.client.get(page['next']).json()
+            seen += [review['review_id'] for review in page['results']]
+            self.assertFalse([query for query in queries if 'OFFSET' in query['sql'] and '"review"' in query['sql']])
+        self.assertEqual(seen, expected)
+
+
+class StripeWebhookTest(TestCase):
+    """
+    Signed events from a Stripe stand-in are stored, then applied once and in status order
+    """
+    secret = 'whsec_test'
+
+    def setUp(self):
+        patches = [mock.patch.object(settings, 'STRIPE_WEBHOOK_SECRET', self.secret),
+                   mock.patch.object(settings, 'STRIPE_EVENT_RETRY_DELAY', 0),
+                   mock.patch.object(stripe_events, 'event_worker'),
+                   mock.patch.object(stripe_events, 'audit')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.order = Orders.objects.create(total_amount=Decimal('10.00'), created_on=timezone.now(), status=0,
+                                           customer_id=1)
+
+    def event(self, event_id, event_type='charge.succeeded', charge_id='ch_1'):
+        return {'id': event_id, 'object': 'event', 'type': event_type,
+                'data': {'object': {'id': charge_id, 'object': 'charge',
+                                    'metadata': {'order_id': str(self.order.order_id)}}}}
+
+    def post(self, event, secret=secret):
+        payload = json.dumps(event)
+        return self.client.post('/stripe/webhooks', payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=stripe_signature(payload, secret))
+
+    def status(self):
+        return Orders.objects.values_list('status', 'auth_code').get(order_id=self.order.order_id)
+
+    def test_event_is_stored_before_it_is_acknowledged(self):
+        response = self.post(self.event('evt_1'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(StripeEvent.objects.values_list('event_id', 'type', 'processed_on')),
+                         [('evt_1', 'charge.succeeded', None)])
+        self.assertEqual(self.status(), (0, None))
+        stripe_events.event_worker.notify.assert_called_once_with()
+
+        self.assertEqual(stripe_events.process_pending(), 1)
+        self.assertEqual(self.status(), (stripe_events.STATUS_PAID, 'ch_1'))
+        self.assertIsNotNone(StripeEvent.objects.get(event_id='evt_1').processed_on)
+
+    def test_duplicates_are_applied_once(self):
+        for _ in range(2):
+            self.assertEqual(self.post(self.event('evt_1')).status_code, 200)
+        self.assertEqual(stripe_events.process_pending(), 1)
+        self.assertEqual(self.post(self.event('evt_1')).status_code, 200)
+        self.assertEqual(stripe_events.process_pending(), 0)
+        self.assertEqual(StripeEvent.objects.count(), 1)
+        self.assertEqual(stripe_events.audit.call_count, 1)
+
+    def test_late_failure_does_not_undo_a_payment(self):
+        self.post(self.event('evt_2', 'charge.failed', 'ch_2'))
+        self.post(self.event('evt_1'))
+        self.post(self.event('evt_3', 'charge.failed', 'ch_3'))
+        self.assertEqual(stripe_events.process_pending(), 3)
+        self.assertEqual(self.status(), (stripe_events.STATUS_PAID, 'ch_1'))
+
+    def test_bad_signature(self):
+        response = self.post(self.event('evt_1'), secret='whsec_other')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error']['code'], 'STR_01')
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_unset_secret(self):
+        with mock.patch.object(settings, 'STRIPE_WEBHOOK_SECRET', None):
+            response = self.post(self.event('evt_1'))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()['error']['code'], 'STR_02')
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_failing_event_is_given_up_until_sent_again(self):
+        self.post(self.event('evt_1'))
+        with mock.patch.object(stripe_events, 'handle_event', side_effect=RuntimeError) as handle_event:
+            self.assertEqual(stripe_events.process_pending(), 0)
+        self.assertEqual(handle_event.call_count, settings.STRIPE_EVENT_RETRIES + 1)
+        self.assertEqual(self.status(), (0, None))
+
+        self.post(self.event('evt_1'))
+        self.assertEqual(stripe_events.process_pending(), 1)
+        self.assertEqual(self.status(), (stripe_events.STATUS_PAID, 'ch_1'))
+
+    def test_command_applies_stored_events(self):
+        self.post(self.event('evt_1'))
+        out = io.StringIO()
+        call_command('process_stripe_events', stdout=out)
+        self.assertIn('Applied 1 Stripe events', out.getvalue())
+        self.assertEqual(self.status(), (stripe_events.STATUS_PAID, 'ch_1'))
+
+
+class StripeStub(ThreadingHTTPServer):
+    """
+    Local stand-in of the Stripe API answering every POST with a charge, after
+    `delay` seconds. Counts the connections opened and keeps the requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        super().__init__(('127.0.0.1', 0), StripeStubHandler)
+        self.delay = delay
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        params = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        with self.server.lock:
+            self.server.requests.append((self.path, self.headers['Authorization'], params))
+        time.sleep(self.server.delay)
+        body = json.dumps({'id': 'ch_1', 'object': 'charge', 'amount': int(params['amount'][0]),
+                           'metadata': {'order_id': params['metadata[order_id]'][0]}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PaymentClientTest(SimpleTestCase):
+    """
+    PaymentClient against a local Stripe stand-in
+    """
+
+    def serve(self, delay=0):
+        server = StripeStub(delay)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def payment_client(self, server, **kwargs):
+        client = payments.PaymentClient(api_key='sk_test_stub', api_base=server.url, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_charges_share_a_connection(self):
+        server = self.serve()
+        client = self.payment_client(server)
+        for order_id in range(5):
+            charge = client.create_charge(999, order_id)
+            self.assertEqual((charge.id, charge.amount, charge.metadata.order_id), ('ch_1', 999, str(order_id)))
+        self.assertEqual(server.connections, 1)
+        path, authorization, params = server.requests[0]
+        self.assertEqual((path, authorization), ('/v1/charges', 'Bearer sk_test_stub'))
+        self.assertEqual(params['source'], ['tok_mastercard'])
+
+    def test_slow_api_times_out(self):
+        server = self.serve(delay=0.5)
+        with mock.patch.object(payments, '_client', self.payment_client(server, timeout=(1, 0.1))):
+            with self.assertRaises(payments.PaymentError) as context:
+                payments.create(999, 1)
+        self.assertEqual(context.exception.message, 'Network communication with Stripe failed')
+
+
+@benchmark
+class PaymentBenchmark(PaymentClientTest):
+    """
+    Charges per second with a new connection per charge against the pooled client
+    """
+    charges = 300
+
+    def run_charges(self, charge, threads):
+        start = time.perf_counter()
+        if threads == 1:
+            for _ in range(self.charges):
+                charge()
+        else:
+            self.assertEqual(run_threads(lambda i: [charge() for _ in range(self.charges // threads)], threads), [])
+        return (time.perf_counter() - start) * 1000 / self.charges
+
+    def test_pooled_against_new_connections(self):
+        server = self.serve()
+        pooled = self.payment_client(server)
+
+        def new_connection():
+            client = payments.PaymentClient(api_key='sk_test_stub', api_base=server.url)
+            client.create_charge(999, 1)
+            client.close()
+
+        print()
+        for threads in (1, 8):
+            for name, charge in (('new connection', new_connection),
+                                 ('pooled', lambda: pooled.create_charge(999, 1))):
+                print('%-50s %9.2f ms/charge' % ('%s threads, %s' % (threads, name),
+                                                 self.run_charges(charge, threads)))
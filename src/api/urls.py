@@ -13,7 +13,7 @@ from api.viewsets.orders import create_order, order, orders, order_details
 from api.viewsets.products import ProductViewSet
 from api.viewsets.shipping_region import ShippingRegionViewSet
 from api.viewsets.shoppingcart import generate_cart_id, add_products, get_products, update_quantity, empty_cart, \
-    remove_product, move_to_cart, total_amount, save_for_later, get_saved_products
+    remove_product, move_to_cart, total_amount, save_for_later, get_saved_products, update_cart
 from api.viewsets.stripe import charge, webhooks
 from api.viewsets.tax import TaxViewSet
 
@@ -37,6 +37,25 @@ urlpatterns = [
     path('products/inCategory/<int:category_id>', ProductViewSet.as_view({"get": "get_products_by_category"})),
     path('products/inDepartment/<int:department_id>', ProductViewSet.as_view({"get": "get_products_by_department"})),
 
+    path('shoppingcart/generateUniqueId', generate_cart_id),
+    path('shoppingcart/add', add_products),
+    path('shoppingcart/batch', update_cart),
+    path('shoppingcart/update/<int:item_id>', update_quantity),
+    path('shoppingcart/empty/<str:cart_id>', empty_cart),
+    path('shoppingcart/moveToCart/<int:item_id>', move_to_cart),
+    path('shoppingcart/totalAmount/<str:cart_id>', total_amount),
+    path('shoppingcart/saveForLater/<int:item_id>', save_for_later),
+    path('shoppingcart/getSaved/<str:cart_id>', get_saved_products),
+    path('shoppingcart/removeProduct/<int:item_id>', remove_product),
+    path('shoppingcart/<str:cart_id>', get_products),
+
+    path('stripe/webhooks', webhooks),
+
+    path('orders', create_order),
+    path('orders/inCustomer', orders),
+    path('orders/shortDetail/<int:order_id>', order_details),
+    path('orders/<int:order_id>', order),
+
     path('customer', customer),
     path('customer/update', update_customer),
 
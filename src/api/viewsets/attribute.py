@@ -1,32 +1,56 @@
+from collections import OrderedDict
+
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
-from api import errors
-from api.models import Attribute, AttributeValue
-from api.serializers import AttributeSerializer, AttributeValueSerializer, AttributeValueExtendedSerializer
+from api.attributes import get_snapshot, resolve_attributes
+from api.conditional import ConditionalGetMixin
+from api.models import Attribute, AttributeValue, ProductAttribute
+from api.serializers import AttributeSerializer
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class AttributeViewSet(viewsets.ReadOnlyModelViewSet):
+class AttributeViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     list: Return a list of attributes
     retrieve: Return a attribute by ID.
     """
     queryset = Attribute.objects.all()
     serializer_class = AttributeSerializer
+    etag_models = (Attribute, AttributeValue, ProductAttribute)
+
+    # Served from the in-process attribute snapshot; only the values of a product are queried
+
+    def list(self, request, *args, **kwargs):
+        logger.debug("Getting attributes")
+        return Response([OrderedDict((('attribute_id', attribute_id), ('name', name)))
+                         for attribute_id, name in get_snapshot().attributes])
+
+    def retrieve(self, request, *args, **kwargs):
+        logger.debug("Getting attribute")
+        for attribute_id, name in get_snapshot().attributes:
+            if str(attribute_id) == kwargs['pk']:
+                return Response(OrderedDict((('attribute_id', attribute_id), ('name', name))))
+        raise NotFound()
 
     @action(detail=False, url_path='values/<int:attribute_id>')
     def get_values_from_attribute(self, request, *args, **kwargs):
         """
         Get Values Attribute from Attribute ID
         """
-        # TODO: place the code here
+        logger.debug("Getting attribute values")
+        values = get_snapshot().attribute_values.get(kwargs['attribute_id'], ())
+        return Response([OrderedDict((('attribute_value_id', value_id), ('value', value)))
+                         for value_id, value in values])
 
     @action(detail=False, url_path='inProduct/<int:product_id>')
     def get_attributes_from_product(self, request, *args, **kwargs):
         """
         Get all Attributes with Product ID
         """
-        # TODO: place the code here
+        logger.debug("Getting attributes of product")
+        product_id = kwargs['product_id']
+        return Response(resolve_attributes([product_id]).get(product_id, []))
@@ -1,5 +1,7 @@
 from rest_framework import viewsets
 
+from api.compiled_serializers import CompiledListModelMixin
+from api.conditional import ConditionalGetMixin
 from api.models import Department
 from api.serializers import DepartmentSerializer
 import logging
@@ -7,10 +9,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class DepartmentViewSet(viewsets.ReadOnlyModelViewSet):
+class DepartmentViewSet(ConditionalGetMixin, CompiledListModelMixin, viewsets.ReadOnlyModelViewSet):
     """
     list: Return a list of departments
     retrieve: Return a department by ID.
     """
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
+    etag_models = (Department,)
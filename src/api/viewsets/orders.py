@@ -1,15 +1,19 @@
 from django.contrib.auth.models import AnonymousUser
-from django.core.mail import EmailMultiAlternatives
 from django.shortcuts import render
-from django.template.loader import render_to_string
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.decorators import api_view
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 
 from api import errors
+from api.audit import ORDER_CREATED, audit
+from api.cart_store import CartOperationError
+from api.checkout import place_order
+from api.mailer import send_order_confirmation
 from api.models import Orders, OrderDetail
-from api.serializers import OrdersSaveSerializer, OrdersSerializer, OrdersDetailSerializer
+from api.serializers import OrdersSaveSerializer, OrdersSerializer, OrdersDetailSerializer, OrdersShortSerializer, \
+    OrderLineSerializer
 import logging
 
 from turing_backend import settings
@@ -17,6 +21,36 @@ from turing_backend import settings
 logger = logging.getLogger(__name__)
 
 
+class OrderSetPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'limit'
+    page_size_query_description = 'Limit per page, Default: 20.'
+    max_page_size = 200
+    # Keyset on idx_orders_customer_created_on, newest orders first
+    ordering = ('-created_on', 'order_id')
+
+
+def get_order(request, order_id):
+    """
+    Header and lines of an order of the signed-in customer in two queries, with
+    the header attached to each line as line.order. Returns (lines, error_response).
+    """
+    try:
+        customer_id = request.user.customer.customer_id
+    except AttributeError:
+        logger.error(errors.USR_10.message)
+        return None, errors.handle(errors.USR_10)
+
+    header = Orders.objects.filter(order_id=order_id, customer_id=customer_id).first()
+    if header is None:
+        logger.error(errors.ORD_01.message)
+        return None, errors.handle(errors.ORD_01)
+    lines = list(OrderDetail.objects.filter(order_id=order_id).order_by('item_id'))
+    for line in lines:
+        line.order = header
+    return lines, None
+
+
 @swagger_auto_schema(method='POST', request_body=openapi.Schema(
     type=openapi.TYPE_OBJECT,
     properties={
@@ -30,7 +64,34 @@ def create_order(request):
     """
     Create a Order
     """
-    # TODO: place the code here
+    logger.debug("Creating an order")
+    try:
+        customer_id = request.user.customer.customer_id
+    except AttributeError:
+        logger.error(errors.USR_10.message)
+        return errors.handle(errors.USR_10)
+
+    for field in ('cart_id', 'shipping_id', 'tax_id'):
+        if not request.data.get(field):
+            errors.COM_01.field = field
+            logger.error(errors.COM_01.message)
+            return errors.handle(errors.COM_01)
+    try:
+        shipping_id, tax_id = int(request.data['shipping_id']), int(request.data['tax_id'])
+    except (TypeError, ValueError):
+        errors.COM_02.message = "shipping_id and tax_id must be numbers"
+        logger.error(errors.COM_02.message)
+        return errors.handle(errors.COM_02)
+
+    try:
+        order_id = place_order(str(request.data['cart_id']), customer_id, shipping_id, tax_id)
+    except CartOperationError as error:
+        logger.error(error.error.message)
+        return errors.handle(error.error)
+    audit(order_id, 'Order created', ORDER_CREATED)
+    send_order_confirmation(order_id, request.user.customer)
+    logger.debug("Success")
+    return Response({'orderId': order_id})
 
 
 @api_view(['GET'])
@@ -38,7 +99,11 @@ def order(request, order_id):
     """
     Get Info about Order
     """
-    # TODO: place the code here
+    logger.debug("Getting order")
+    lines, error = get_order(request, order_id)
+    if error:
+        return error
+    return Response(OrderLineSerializer(lines, many=True).data)
 
 
 @api_view(['GET'])
@@ -47,7 +112,10 @@ def order_details(request, order_id):
     Get Info about Order
     """
     logger.debug("Getting detail info")
-    # TODO: place the code here
+    lines, error = get_order(request, order_id)
+    if error:
+        return error
+    return Response(OrdersDetailSerializer(lines, many=True).data)
 
 
 @api_view(['GET'])
@@ -55,7 +123,17 @@ def orders(request):
     """
     Get orders by Customer
     """
-    # TODO: place the code here
+    logger.debug("Getting orders of customer")
+    try:
+        customer_id = request.user.customer.customer_id
+    except AttributeError:
+        logger.error(errors.USR_10.message)
+        return errors.handle(errors.USR_10)
+
+    paginator = OrderSetPagination()
+    page = paginator.paginate_queryset(Orders.objects.filter(customer_id=customer_id)
+                                       .values(*OrdersShortSerializer.Meta.fields), request)
+    return paginator.get_paginated_response(OrdersShortSerializer(page, many=True).data)
 
 
 @api_view(['GET'])
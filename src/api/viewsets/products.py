@@ -1,30 +1,187 @@
+import bisect
 import logging
+from array import array
+from collections import OrderedDict
 
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import viewsets
+from rest_framework.compat import coreapi, coreschema
 from rest_framework.decorators import action
-from rest_framework.filters import SearchFilter
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 
-from api import errors
-from api.models import Category, Product, Review
-from api.serializers import ProductSerializer, ReviewSerializer
+from api import errors, export, ratings, search
+from api.attributes import resolve_attributes
+from api.cache import get_version, versioned_key
+from api.compiled_serializers import CompiledListModelMixin, compile_serializer
+from api.conditional import ConditionalGetMixin
+from api.catalog_index import index
+from api.models import Attribute, AttributeValue, Category, Customer, Product, ProductAttribute, ProductCategory, \
+    ProductRating, Review
+from api.serializers import ProductSerializer, ReviewSerializer, ProductDetailSerializer, ProductReviewSerializer
+from turing_backend import settings
 
 logger = logging.getLogger(__name__)
 
 
+class InvalidCursor(Exception):
+    """
+    A cursor that can't be decoded, answered with PRO_04
+    """
+
+
 class ProductSetPagination(PageNumberPagination):
     page_size = 20
     page_query_description = 'Inform the page. Starting with 1. Default: 1'
     page_size_query_param = 'limit'
     page_size_query_description = 'Limit per page, Default: 20.'
     max_page_size = 200
+    cursor_query_param = 'cursor'
+    cursor_query_description = 'Return the products after this cursor, taken from the next link, ' \
+                               'instead of a numbered page. Use 0 to start.'
+    count_query_param = 'count'
+    count_query_description = "With a cursor, set to 'approx' to include an approximate total."
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor = self.get_cursor(request)
+        if self.cursor is None:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.position = None
+        page_size = self.get_page_size(request)
+        if isinstance(queryset, QuerySet):
+            # Keyset: seek past the cursor on the primary key instead of scanning an OFFSET
+            rows = list(queryset.filter(product_id__gt=self.cursor[0]).order_by('product_id')[:page_size + 1])
+        elif isinstance(queryset, array):
+            # Membership arrays are sorted, so seek with a binary search
+            start = bisect.bisect_right(queryset, self.cursor[0])
+            rows = queryset[start:start + page_size + 1]
+        else:
+            self.position = self.get_position(queryset)
+            rows = queryset[self.position:self.position + page_size + 1]
+        self.has_next = len(rows) > page_size
+        self.page = rows[:page_size]
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'approx':
+            self.count = self.get_approximate_count(queryset)
+        return self.page
+
+    def get_paginated_response(self, data):
+        if self.cursor is None:
+            return super().get_paginated_response(data)
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+            response.move_to_end('count', last=False)
+        return Response(response)
+
+    def get_next_link(self):
+        if self.cursor is None:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        last = getattr(self.page[-1], 'product_id', self.page[-1])
+        cursor = last
+        if self.position is not None:
+            # Ranked lists aren't ordered by ID, so the cursor also carries the position
+            cursor = '%s:%s' % (last, self.position + len(self.page))
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_cursor(self, request):
+        """
+        The cursor as (product_id, position), position None unless given
+        """
+        if self.cursor_query_param not in request.query_params:
+            return None
+        value = request.query_params[self.cursor_query_param] or '0'
+        product_id, _, position = value.partition(':')
+        try:
+            cursor = int(product_id), int(position) if position else None
+        except ValueError:
+            raise InvalidCursor(value)
+        if cursor[0] < 0 or (cursor[1] or 0) < 0:
+            raise InvalidCursor(value)
+        return cursor
+
+    def get_position(self, product_ids):
+        """
+        Position right after the cursor in a ranked list of product IDs
+        """
+        product_id, position = self.cursor
+        if not product_id:
+            return 0
+        try:
+            return product_ids.index(product_id) + 1
+        except ValueError:
+            if position is None:
+                raise InvalidCursor(product_id)
+        # The product left the results since the previous page, which moved the
+        # products after it up by one
+        return min(max(position - 1, 0), len(product_ids))
+
+    def get_approximate_count(self, queryset):
+        """
+        Total of a listing, counted once per version of the product table
+        """
+        if not isinstance(queryset, QuerySet):
+            return len(queryset)
+        key = versioned_key(Product._meta.db_table, 'count', queryset.query)
+        return cache.get_or_set(key, queryset.count, settings.CATALOG_CACHE_TIMEOUT)
+
+    def get_schema_fields(self, view):
+        return super().get_schema_fields(view) + [
+            coreapi.Field(
+                name=self.cursor_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description=self.cursor_query_description
+                )
+            ),
+            coreapi.Field(
+                name=self.count_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Count',
+                    description=self.count_query_description
+                )
+            ),
+        ]
+
+
+class ReviewSetPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'limit'
+    page_size_query_description = 'Limit per page, Default: 20.'
+    max_page_size = 200
+    # Keyset on (product_id, created_on), newest reviews first
+    ordering = ('-created_on', '-review_id')
 
+    def decode_cursor(self, request):
+        try:
+            return super().decode_cursor(request)
+        except NotFound:
+            raise InvalidCursor(request.query_params.get(self.cursor_query_param))
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+
+class ProductViewSet(ConditionalGetMixin, CompiledListModelMixin, viewsets.ReadOnlyModelViewSet):
     """
     list: Return a list of products
     retrieve: Return a product by ID.
@@ -32,34 +189,180 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Product.objects.all().order_by('product_id')
     serializer_class = ProductSerializer
     pagination_class = ProductSetPagination
-    filter_backends = (SearchFilter,)
-    search_fields = ('name', 'description')
+    # Tables besides product whose changes invalidate the cached responses of an action
+    cache_dependencies = {
+        'get_products_by_category': (ProductCategory, Category),
+        'get_products_by_department': (ProductCategory, Category),
+        'details': (ProductAttribute, AttributeValue, Attribute, ProductRating),
+        'reviews': (Review, Customer),
+        'export_products': (ProductCategory, ProductAttribute, AttributeValue, Attribute),
+    }
+    include_query_param = 'include'
+
+    def get_includes(self):
+        """
+        Extra data embedded in each product, e.g. ?include=attributes
+        """
+        return set(self.request.GET.get(self.include_query_param, '').split(','))
+
+    def get_cache_dependencies(self):
+        dependencies = self.cache_dependencies.get(self.action, ())
+        includes = self.get_includes()
+        if 'attributes' in includes:
+            dependencies += (ProductAttribute, AttributeValue, Attribute)
+        if 'rating' in includes:
+            dependencies += (ProductRating,)
+        return dependencies
 
+    def get_etag_models(self):
+        return (Product,) + self.get_cache_dependencies()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, InvalidCursor):
+            logger.error("%s: %s", errors.PRO_04.message, exc)
+            return errors.handle(errors.PRO_04)
+        return super().handle_exception(exc)
+
+    def cached_response(self, request, handler, *args, **kwargs):
+        """
+        Serve the serialized response from the catalog cache, building it on a miss
+        """
+        versions = [get_version(model._meta.db_table) for model in self.get_cache_dependencies()]
+        key = versioned_key(Product._meta.db_table, self.action, request.get_host(), request.get_full_path(),
+                            *versions)
+        data = cache.get(key)
+        if data is not None:
+            logger.debug("Catalog cache hit")
+            return Response(data)
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(request, super().retrieve, *args, **kwargs)
+
+    @swagger_auto_schema(method='GET', manual_parameters=[
+        openapi.Parameter('query_string', openapi.IN_QUERY, description='Query to search.', type=openapi.TYPE_STRING,
+                          required=True),
+        openapi.Parameter('all_words', openapi.IN_QUERY, description="All words or not. Default: 'on'",
+                          type=openapi.TYPE_STRING, enum=['on', 'off']),
+    ])
     @action(methods=['GET'], detail=False, url_path='search', url_name='Search products')
     def search(self, request, *args, **kwargs):
         """        
         Search products
         """
-        return super().list(request, *args, **kwargs)
+        return self.cached_response(request, self.search_products, *args, **kwargs)
+
+    def search_products(self, request, *args, **kwargs):
+        query_string = request.query_params.get('query_string', request.query_params.get('search', ''))
+        all_words = request.query_params.get('all_words', 'on') != 'off'
+        logger.debug("Searching products")
+
+        return self.paginated_response(search.search_products(query_string, all_words))
+
+    def get_paginated_response(self, data):
+        includes = self.get_includes()
+        if 'attributes' in includes:
+            attributes = resolve_attributes([row['product_id'] for row in data])
+            for row in data:
+                row['attributes'] = attributes.get(row['product_id'], [])
+        if 'rating' in includes:
+            summaries = ratings.get_ratings([row['product_id'] for row in data])
+            for row in data:
+                row['rating'] = summaries[row['product_id']]
+        return super().get_paginated_response(data)
+
+    def paginated_response(self, product_ids):
+        """
+        Paginate a list of product IDs and fetch only the products of the page
+        """
+        page = self.paginate_queryset(product_ids)
+        compiled = compile_serializer(self.get_serializer_class())
+        rows = {row.product_id: row for row in compiled.values(self.get_queryset().filter(product_id__in=page))}
+        return self.get_paginated_response(compiled.serialize(rows[pk] for pk in page if pk in rows))
 
     def get_products_by_category(self, request, category_id):
         """
         Get a list of Products by Categories
         """
-        # TODO: place the code here
+        return self.cached_response(request, self.products_by_category, category_id)
+
+    def products_by_category(self, request, category_id):
+        logger.debug("Getting products by category")
+        product_ids = index.products_in_category(category_id)
+        if product_ids is None:
+            logger.error(errors.CAT_01.message)
+            return errors.handle(errors.CAT_01)
+        return self.paginated_response(product_ids)
 
     def get_products_by_department(self, request, department_id):
         """
         Get a list of Products of Departments
         """
-        # TODO: place the code here
+        return self.cached_response(request, self.products_by_department, department_id)
+
+    def products_by_department(self, request, department_id):
+        logger.debug("Getting products by department")
+        product_ids = index.products_in_department(department_id)
+        if product_ids is None:
+            logger.error(errors.DEP_02.message)
+            return errors.handle(errors.DEP_02)
+        return self.paginated_response(product_ids)
+
+    @swagger_auto_schema(method='GET', manual_parameters=[
+        openapi.Parameter('output', openapi.IN_QUERY, description="Format of the feed. Default: 'ndjson'",
+                          type=openapi.TYPE_STRING, enum=sorted(export.FORMATS)),
+        openapi.Parameter('after', openapi.IN_QUERY, description='Resume after this product ID.',
+                          type=openapi.TYPE_INTEGER),
+    ])
+    @action(methods=['GET'], detail=False, url_path='export', url_name='Export products')
+    def export_products(self, request, *args, **kwargs):
+        """
+        Stream the whole catalog with categories and attributes
+        """
+        logger.debug("Exporting products")
+        output = request.query_params.get('output', 'ndjson')
+        if output not in export.FORMATS:
+            logger.error(errors.PRO_02.message)
+            return errors.handle(errors.PRO_02)
+        try:
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            logger.error(errors.PRO_03.message)
+            return errors.handle(errors.PRO_03)
+
+        render, content_type = export.FORMATS[output]
+        response = StreamingHttpResponse(render(export.iter_chunks(after, settings.EXPORT_CHUNK_SIZE)),
+                                         content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="products.%s"' % output
+        return response
 
     @action(methods=['GET'], detail=True, url_path='details')
     def details(self, request, pk):
         """
         Get details of a Product
         """
-        # TODO: place the code here
+        return self.cached_response(request, self.product_details, pk)
+
+    def product_details(self, request, pk):
+        logger.debug("Getting product details")
+        try:
+            product = Product.objects.get(product_id=pk)
+        except (Product.DoesNotExist, ValueError):
+            logger.error(errors.PRO_01.message)
+            return errors.handle(errors.PRO_01)
+
+        data = ProductDetailSerializer(product).data
+        data['attributes'] = resolve_attributes([product.product_id]).get(product.product_id, [])
+        data['rating'] = ratings.get_ratings([product.product_id])[product.product_id]
+        logger.debug("Success")
+        return Response(data)
 
     @action(methods=['GET'], detail=True, url_path='locations')
     def locations(self, request, pk):
@@ -73,7 +376,15 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         """
         Return a list of reviews
         """
-        # TODO: place the code here
+        logger.debug("Getting reviews")
+        paginator = ReviewSetPagination()
+        page = paginator.paginate_queryset(Review.objects.filter(product_id=pk), request, view=self)
+        names = dict(Customer.objects.filter(customer_id__in={review.customer_id for review in page})
+                     .values_list('customer_id', 'name'))
+        data = ProductReviewSerializer(page, many=True).data
+        for row in data:
+            row['name'] = names.get(row['customer_id'])
+        return paginator.get_paginated_response(data)
 
     @swagger_auto_schema(method='POST', request_body=openapi.Schema(
         type=openapi.TYPE_OBJECT,
@@ -87,4 +398,27 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         """
         Create a new review
         """
-        # TODO: place the code here
+        logger.debug("Creating review")
+        try:
+            customer_id = request.user.customer.customer_id
+        except AttributeError:
+            logger.error(errors.USR_10.message)
+            return errors.handle(errors.USR_10)
+
+        if not Product.objects.filter(product_id=pk).exists():
+            logger.error(errors.PRO_01.message)
+            return errors.handle(errors.PRO_01)
+
+        serializer = ReviewSerializer(data={'product_id': pk, 'customer_id': customer_id,
+                                            'review': request.data.get('review'),
+                                            'rating': request.data.get('rating')})
+        if not serializer.is_valid():
+            errors.COM_02.message = str(serializer.errors)
+            logger.error(errors.COM_02.message)
+            return errors.handle(errors.COM_02)
+
+        with transaction.atomic():
+            serializer.save(created_on=timezone.now())
+            ratings.record_rating(serializer.instance.product_id, serializer.instance.rating)
+        logger.debug("Success")
+        return Response(serializer.data, status=201)
@@ -1,5 +1,7 @@
 from rest_framework import viewsets
 
+from api.compiled_serializers import CompiledListModelMixin
+from api.conditional import ConditionalGetMixin
 from api.models import ShippingRegion
 from api.serializers import ShippingRegionSerializer
 import logging
@@ -7,10 +9,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class ShippingRegionViewSet(viewsets.ReadOnlyModelViewSet):
+class ShippingRegionViewSet(ConditionalGetMixin, CompiledListModelMixin, viewsets.ReadOnlyModelViewSet):
     """
     list: Get All ShippingRegions
     retrieve: Get ShippingRegion by ID
     """
     queryset = ShippingRegion.objects.all()
     serializer_class = ShippingRegionSerializer
+    etag_models = (ShippingRegion,)
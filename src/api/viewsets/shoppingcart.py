@@ -1,27 +1,102 @@
 import uuid
+from collections import OrderedDict
 
-from django.utils import timezone
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework.decorators import api_view, action
+from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK
 
 from api import errors
-from api.models import ShoppingCart
-from api.serializers import ShoppingcartSerializer, ProductSerializer
+from api.cart_store import CartOperationError, get_storage, with_products
+from api.models import Product, ShoppingCart
+from api.serializers import CartBatchSerializer
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def cart_products(items):
+    """
+    Products in the cart, like shopping_cart_get_products
+    """
+    return [OrderedDict((
+        ('item_id', item['item_id']),
+        ('name', item['name']),
+        ('attributes', item['attributes']),
+        ('product_id', item['product_id']),
+        ('price', str(item['price'])),
+        ('quantity', item['quantity']),
+        ('image', item['image']),
+        ('subtotal', str(item['price'] * item['quantity'])),
+        ('version', item['version']),
+    )) for item in items if item['buy_now']]
+
+
+def cart_total(items):
+    """
+    Total amount of the cart, like shopping_cart_get_total_amount
+    """
+    items = [item for item in items if item['buy_now']]
+    if not items:
+        return None
+    return str(sum(item['price'] * item['quantity'] for item in items))
+
+
+def cart_response(cart_id):
+    return Response(cart_products(get_storage().get_products(cart_id)))
+
+
+def check_lengths(**values):
+    """
+    Error response for the first value longer than its shopping_cart column, None when they all fit
+    """
+    for field, value in values.items():
+        if len(value) > ShoppingCart._meta.get_field(field).max_length:
+            errors.USR_07.field = field
+            logger.error(errors.USR_07.message)
+            return errors.handle(errors.USR_07)
+    return None
+
+
+def read_version(request):
+    """
+    Version of the item the client last read, from the body or the query string.
+    Raises ValueError when it isn't a number.
+    """
+    version = request.data.get('version', request.query_params.get('version'))
+    return None if version in (None, '') else int(version)
+
+
+def change_item(request, item_id, change, *args):
+    """
+    Run a change of an item of the storage with the version sent by the client,
+    returning its result or the error response
+    """
+    try:
+        version = read_version(request)
+    except (TypeError, ValueError):
+        errors.COM_02.field = 'version'
+        logger.error(errors.COM_02.message)
+        return None, errors.handle(errors.COM_02)
+    try:
+        result = change(item_id, *args, version=version)
+    except CartOperationError as error:
+        logger.error(error.error.message)
+        return None, errors.handle(error.error)
+    if not result:
+        logger.error(errors.SHP_02.message)
+        return None, errors.handle(errors.SHP_02)
+    return result, None
+
+
 @api_view(['GET'])
 def generate_cart_id(request):
     """
     Generate the unique CART ID 
     """
     logger.debug("Generating cart ID")
-    return Response({"cart_id": uuid.uuid4()})
+    return Response({"cart_id": uuid.uuid4().hex})
 
 
 @swagger_auto_schema(method='POST', request_body=openapi.Schema(
@@ -37,7 +112,61 @@ def add_products(request):
     """
     Add a Product in the cart
     """
-    # TODO: place the code here
+    logger.debug("Adding a product in the cart")
+    for field in ('cart_id', 'product_id', 'attributes'):
+        if not request.data.get(field):
+            errors.COM_01.field = field
+            logger.error(errors.COM_01.message)
+            return errors.handle(errors.COM_01)
+    try:
+        product_id = int(request.data['product_id'])
+    except (TypeError, ValueError):
+        errors.COM_02.field = 'product_id'
+        logger.error(errors.COM_02.message)
+        return errors.handle(errors.COM_02)
+    cart_id, attributes = str(request.data['cart_id']), str(request.data['attributes'])
+    error = check_lengths(cart_id=cart_id, attributes=attributes)
+    if error:
+        return error
+    if not Product.objects.filter(product_id=product_id).exists():
+        logger.error(errors.PRO_01.message)
+        return errors.handle(errors.PRO_01)
+    get_storage().add(cart_id, product_id, attributes)
+    logger.debug("Success")
+    return cart_response(cart_id)
+
+
+@swagger_auto_schema(method='POST', request_body=CartBatchSerializer)
+@api_view(['POST'])
+def update_cart(request):
+    """
+    Apply a list of add, update, remove, save and move operations to a cart at once
+    """
+    logger.debug("Updating the cart in batch")
+    serializer = CartBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        errors.COM_02.message = str(serializer.errors)
+        logger.error(errors.COM_02.message)
+        return errors.handle(errors.COM_02)
+    cart_id, operations = serializer.validated_data['cart_id'], serializer.validated_data['operations']
+
+    product_ids = {operation['product_id'] for operation in operations if operation['action'] == 'add'}
+    if product_ids and Product.objects.filter(product_id__in=product_ids).count() != len(product_ids):
+        logger.error(errors.PRO_01.message)
+        return errors.handle(errors.PRO_01)
+    try:
+        items = get_storage().apply(cart_id, operations)
+    except CartOperationError as error:
+        logger.error(error.error.message)
+        return errors.handle(error.error)
+
+    items = with_products(items)
+    logger.debug("Success")
+    return Response(OrderedDict((
+        ('cart_id', cart_id),
+        ('products', cart_products(items)),
+        ('total_amount', cart_total(items)),
+    )))
 
 
 @api_view(['GET'])
@@ -45,13 +174,15 @@ def get_products(request, cart_id):
     """
     Get List of Products in Shopping Cart
     """
-    # TODO: place the code here
+    logger.debug("Getting products in the cart")
+    return cart_response(cart_id)
 
 
 @swagger_auto_schema(method='PUT', request_body=openapi.Schema(
     type=openapi.TYPE_OBJECT,
     properties={
-        'quantity': openapi.Schema(type=openapi.TYPE_INTEGER, description='Item Quantity.', required=['true'])
+        'quantity': openapi.Schema(type=openapi.TYPE_INTEGER, description='Item Quantity.', required=['true']),
+        'version': openapi.Schema(type=openapi.TYPE_INTEGER, description='Version of the item last read.'),
     }
 ))
 @api_view(['PUT'])
@@ -60,7 +191,21 @@ def update_quantity(request, item_id):
     Update the cart by item
     """
     logger.debug("Updating quantity")
-    # TODO: place the code here
+    try:
+        quantity = int(request.data['quantity'])
+    except KeyError:
+        errors.COM_01.field = 'quantity'
+        logger.error(errors.COM_01.message)
+        return errors.handle(errors.COM_01)
+    except (TypeError, ValueError):
+        errors.COM_02.field = 'quantity'
+        logger.error(errors.COM_02.message)
+        return errors.handle(errors.COM_02)
+    cart_id, error = change_item(request, item_id, get_storage().update_quantity, quantity)
+    if error:
+        return error
+    logger.debug("Success")
+    return cart_response(cart_id)
 
 
 @api_view(['DELETE'])
@@ -68,7 +213,12 @@ def empty_cart(request, cart_id):
     """
     Empty cart
     """
-    # TODO: place the code here
+    logger.debug("Emptying the cart")
+    error = check_lengths(cart_id=cart_id)
+    if error:
+        return error
+    get_storage().empty(cart_id)
+    return Response([])
 
 
 @api_view(['DELETE'])
@@ -76,7 +226,12 @@ def remove_product(request, item_id):
     """
     Remove a product in the cart
     """
-    # TODO: place the code here
+    logger.debug("Removing a product from the cart")
+    _, error = change_item(request, item_id, get_storage().remove)
+    if error:
+        return error
+    logger.debug("Success")
+    return Response(status=HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -84,7 +239,12 @@ def move_to_cart(request, item_id):
     """
     Move a product to cart
     """
-    # TODO: place the code here
+    logger.debug("Moving a product to the cart")
+    _, error = change_item(request, item_id, get_storage().move, True)
+    if error:
+        return error
+    logger.debug("Success")
+    return Response(status=HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -92,7 +252,9 @@ def total_amount(request, cart_id):
     """
     Return a total Amount from Cart
     """
-    # TODO: place the code here
+    logger.debug("Getting the total amount of the cart")
+    item_count, subtotal = get_storage().get_summary(cart_id)
+    return Response({'total_amount': str(subtotal) if item_count else None})
 
 
 @api_view(['GET'])
@@ -100,7 +262,12 @@ def save_for_later(request, item_id):
     """
     Save a Product for latter
     """
-    # TODO: place the code here
+    logger.debug("Saving a product for later")
+    _, error = change_item(request, item_id, get_storage().move, False)
+    if error:
+        return error
+    logger.debug("Success")
+    return Response(status=HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -108,4 +275,11 @@ def get_saved_products(request, cart_id):
     """
     Get saved Products 
     """
-    # TODO: place the code here
+    logger.debug("Getting saved products")
+    return Response([OrderedDict((
+        ('item_id', item['item_id']),
+        ('name', item['name']),
+        ('attributes', item['attributes']),
+        ('price', str(item['price'])),
+        ('version', item['version']),
+    )) for item in get_storage().get_products(cart_id, buy_now=False)])
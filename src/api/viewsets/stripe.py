@@ -1,10 +1,12 @@
+import stripe
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from api import payments, errors
+from api import payments, errors, stripe_events
 from api.payments import PaymentError
+from turing_backend import settings
 import logging
 
 logger = logging.getLogger(__name__)
@@ -40,4 +42,20 @@ def webhooks(request):
     """
     Endpoint that provide a synchronization
     """
-    # TODO: place the code here
+    logger.debug("Receiving a webhook")
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        # Stripe sends the event again once the secret is set
+        logger.error(errors.STR_02.message)
+        return errors.handle(errors.STR_02)
+    try:
+        event = stripe.Webhook.construct_event(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''),
+                                               settings.STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError):
+        logger.error(errors.STR_01.message)
+        return errors.handle(errors.STR_01)
+
+    # Stored before answering, so an event acknowledged is never lost
+    if not stripe_events.record(event, request.body.decode('utf-8')):
+        logger.debug("Event %s already received", event['id'])
+    stripe_events.event_worker.notify()
+    return Response({'received': True})
@@ -1,5 +1,7 @@
 from rest_framework import viewsets
 
+from api.compiled_serializers import CompiledListModelMixin
+from api.conditional import ConditionalGetMixin
 from api.models import Tax
 from api.serializers import TaxSerializer
 import logging
@@ -7,10 +9,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class TaxViewSet(viewsets.ReadOnlyModelViewSet):
+class TaxViewSet(ConditionalGetMixin, CompiledListModelMixin, viewsets.ReadOnlyModelViewSet):
     """
     list: Get All Taxes
     retrieve: Get Tax by ID
     """
     queryset = Tax.objects.all()
     serializer_class = TaxSerializer
+    etag_models = (Tax,)
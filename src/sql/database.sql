@@ -74,9 +74,36 @@ CREATE TABLE `shopping_cart` (
   `quantity`    INT           NOT NULL,
   `buy_now`     BOOL          NOT NULL  DEFAULT true,
   `added_on`    DATETIME      NOT NULL,
+  `version`     INT           NOT NULL  DEFAULT '0',
+  `attributes_hash` CHAR(32)  AS (MD5(`attributes`)) STORED,
   PRIMARY KEY (`item_id`),
-  KEY `idx_shopping_cart_cart_id` (`cart_id`)
-) ENGINE=MyISAM;
+  UNIQUE KEY `idx_shopping_cart_cart_id_product_id_attributes` (`cart_id`, `product_id`, `attributes_hash`),
+  KEY `idx_shopping_cart_cart_buy_now` (`cart_id`, `buy_now`),
+  KEY `idx_shopping_cart_product_cart` (`product_id`, `cart_id`)
+) ENGINE=InnoDB;
+
+-- Create shopping_cart_summary table (items and subtotal of the products to buy, per cart)
+CREATE TABLE `shopping_cart_summary` (
+  `cart_id`    CHAR(32)      NOT NULL,
+  `item_count` INT           NOT NULL  DEFAULT '0',
+  `subtotal`   DECIMAL(10,2) NOT NULL  DEFAULT '0.00',
+  PRIMARY KEY (`cart_id`)
+) ENGINE=InnoDB;
+
+-- Create shopping_cart_dirty table (carts changed in the cache and not written to shopping_cart yet,
+-- with their items as JSON so that a cart evicted from the cache is still flushed)
+CREATE TABLE `shopping_cart_dirty` (
+  `cart_id` CHAR(32)   NOT NULL,
+  `items`   MEDIUMTEXT NOT NULL,
+  PRIMARY KEY (`cart_id`)
+) ENGINE=InnoDB;
+
+-- Create id_sequence table (ids handed out outside of AUTO_INCREMENT, e.g. to cached cart items)
+CREATE TABLE `id_sequence` (
+  `name`       VARCHAR(50) NOT NULL,
+  `last_value` INT         NOT NULL  DEFAULT '0',
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB;
 
 -- Create orders table
 CREATE TABLE `orders` (
@@ -92,10 +119,12 @@ CREATE TABLE `orders` (
   `shipping_id`  INT,
   `tax_id`       INT,
   PRIMARY KEY  (`order_id`),
-  KEY `idx_orders_customer_id` (`customer_id`),
+  -- Order history: seek by customer, newest first, list columns read from the index
+  KEY `idx_orders_customer_created_on` (`customer_id`, `created_on` DESC, `order_id`,
+                                        `total_amount`, `shipped_on`, `status`),
   KEY `idx_orders_shipping_id` (`shipping_id`),
   KEY `idx_orders_tax_id` (`tax_id`)
-) ENGINE=MyISAM;
+) ENGINE=InnoDB;
 
 -- Create order_details table
 CREATE TABLE `order_detail` (
@@ -108,7 +137,7 @@ CREATE TABLE `order_detail` (
   `unit_cost`    DECIMAL(10,2) NOT NULL,
   PRIMARY KEY  (`item_id`),
   KEY `idx_order_detail_order_id` (`order_id`)
-) ENGINE=MyISAM;
+) ENGINE=InnoDB;
 
 -- Create shipping_region table
 CREATE TABLE `shipping_region` (
@@ -168,6 +197,19 @@ CREATE TABLE `audit` (
   KEY `idx_audit_order_id` (`order_id`)
 ) ENGINE=MyISAM;
 
+-- Create stripe_event table (verified webhook events, stored before they are acknowledged until applied)
+CREATE TABLE `stripe_event` (
+  `event_id`     VARCHAR(100) NOT NULL,
+  `type`         VARCHAR(100) NOT NULL,
+  `payload`      MEDIUMTEXT   NOT NULL,
+  `received_on`  DATETIME     NOT NULL,
+  `attempts`     INT          NOT NULL  DEFAULT '0',
+  `attempted_on` DATETIME,
+  `processed_on` DATETIME,
+  PRIMARY KEY (`event_id`),
+  KEY `idx_stripe_event_processed_on` (`processed_on`, `received_on`)
+) ENGINE=InnoDB;
+
 -- Create review table
 CREATE TABLE `review` (
   `review_id`   INT      NOT NULL  AUTO_INCREMENT,
@@ -178,8 +220,21 @@ CREATE TABLE `review` (
   `created_on`  DATETIME NOT NULL,
   PRIMARY KEY (`review_id`),
   KEY `idx_review_customer_id` (`customer_id`),
-  KEY `idx_review_product_id` (`product_id`)
-) ENGINE=MyISAM;
+  KEY `idx_review_product_id_created_on` (`product_id`, `created_on`)
+) ENGINE=InnoDB;
+
+-- Create product_rating table (rating summary per product, kept in step with review)
+CREATE TABLE `product_rating` (
+  `product_id`   INT NOT NULL,
+  `review_count` INT NOT NULL DEFAULT '0',
+  `rating_sum`   INT NOT NULL DEFAULT '0',
+  `rating_1`     INT NOT NULL DEFAULT '0',
+  `rating_2`     INT NOT NULL DEFAULT '0',
+  `rating_3`     INT NOT NULL DEFAULT '0',
+  `rating_4`     INT NOT NULL DEFAULT '0',
+  `rating_5`     INT NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product_id`)
+) ENGINE=InnoDB;
 
 -- Populate department table
 INSERT INTO `department` (`department_id`, `name`, `description`) VALUES
@@ -199,6 +199,87 @@ SWAGGER_SETTINGS = {
     }
 }
 
+# Seconds a serialized catalog page stays cached. Entries are also invalidated
+# as soon as one of the rows they were built from changes.
+CATALOG_CACHE_TIMEOUT = 60 * 15
+
+# Seconds a change of product_category stays published for the membership
+# indexes of other processes, and the most changes an index applies to catch up.
+# An index further behind rebuilds from the tables.
+MEMBERSHIP_DELTA_TIMEOUT = 60 * 60
+MEMBERSHIP_MAX_DELTAS = 1000
+
+# Cache-Control of catalog and reference responses, overridable per viewset
+CATALOG_CACHE_CONTROL = {'public': True, 'max_age': 60, 'must_revalidate': True}
+
+# Search engine behind /products/search. MySQL uses the FULLTEXT index on
+# product(name, description), other databases an in-process inverted index.
+# Set a dotted path to force a backend.
+PRODUCT_SEARCH_BACKEND = None
+PRODUCT_SEARCH_MAX_RESULTS = 1000
+
+# Products read per query by the streaming catalog export
+EXPORT_CHUNK_SIZE = 1000
+
+# Storage engine of the shopping carts. CacheCartStorage keeps carts in the
+# CART_CACHE cache, with a durable copy of each changed cart in
+# shopping_cart_dirty, and writes them behind to shopping_cart every
+# CART_FLUSH_INTERVAL seconds; DatabaseCartStorage goes to the table on every
+# request. Cached items get their ids from the
+# id_sequence table, CART_ITEM_ID_BLOCK at a time per process.
+CART_STORAGE = 'api.cart_store.CacheCartStorage'
+CART_CACHE = 'default'
+CART_CACHE_TIMEOUT = 60 * 60 * 24
+CART_FLUSH_INTERVAL = 5
+CART_FLUSH_BATCH_SIZE = 500
+CART_LOCK_TIMEOUT = 5
+CART_ITEM_ID_BLOCK = 100
+
+# Carts not changed for CART_TTL seconds are deleted by the reap_carts command,
+# CART_REAP_CHUNK_SIZE rows per statement with CART_REAP_PAUSE seconds in between
+CART_TTL = 60 * 60 * 24 * 7
+CART_REAP_CHUNK_SIZE = 1000
+CART_REAP_PAUSE = 0.1
+
+# Order emails are sent by a background thread, ORDER_EMAIL_BATCH_SIZE per SMTP
+# connection use; failed batches are retried ORDER_EMAIL_RETRIES times, waiting
+# ORDER_EMAIL_RETRY_DELAY seconds and twice as long after each failure
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'webmaster@localhost')
+ORDER_EMAIL_QUEUE_SIZE = 10000
+ORDER_EMAIL_BATCH_SIZE = 50
+ORDER_EMAIL_IDLE_TIMEOUT = 30
+ORDER_EMAIL_RETRIES = 3
+ORDER_EMAIL_RETRY_DELAY = 2
+
+# Audit rows are written in the background, AUDIT_BATCH_SIZE rows per INSERT or
+# every AUDIT_FLUSH_INTERVAL seconds; requests block once AUDIT_BUFFER_SIZE rows
+# are waiting. Failed writes are retried from AUDIT_RETRY_DELAY seconds, doubling
+# up to AUDIT_MAX_RETRY_DELAY; only rows the database refuses are dropped
+AUDIT_BUFFER_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 1
+AUDIT_RETRY_DELAY = 1
+AUDIT_MAX_RETRY_DELAY = 30
+
+# Stripe calls go to STRIPE_API_BASE (a local stub in tests) over a pool of
+# STRIPE_POOL_SIZE keep-alive connections, with connect and read timeouts in seconds
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_POOL_SIZE = 10
+STRIPE_CONNECT_TIMEOUT = 5
+STRIPE_READ_TIMEOUT = 30
+
+# Stripe webhook events are verified with STRIPE_WEBHOOK_SECRET and stored in
+# stripe_event before they are acknowledged, then applied in the background,
+# STRIPE_EVENT_BATCH_SIZE per query. A failed event is retried STRIPE_EVENT_RETRIES
+# times, STRIPE_EVENT_RETRY_DELAY seconds after the first failure and twice as long
+# after each next one; the worker looks for due events every STRIPE_EVENT_POLL_INTERVAL
+# seconds
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET')
+STRIPE_EVENT_BATCH_SIZE = 100
+STRIPE_EVENT_RETRIES = 3
+STRIPE_EVENT_RETRY_DELAY = 1
+STRIPE_EVENT_POLL_INTERVAL = 5
+
 WEBHOOK = {
     "url": "https://example.com/my/webhook/endpoint",
     "enabled_events": ['charge.failed', 'charge.succeeded']
@@ -0,0 +1,39 @@
+import tempfile
+
+from .base import *
+
+# python manage.py test api, with DJANGO_SETTINGS_MODULE=turing_backend.settings.test
+
+STRIPE_API_KEY = "sk_test_lomdOfxbm7QDgZWvR82UhV6D"
+
+# A file rather than an in-memory database, so tests can use it from several
+# threads; timeout is how long a connection waits for another one's write lock
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'turing.sqlite3'),
+        'OPTIONS': {'timeout': 60},
+        'TEST': {
+            'NAME': os.path.join(tempfile.gettempdir(), 'test_turing.sqlite3'),
+        },
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# The api tables are created from the models, see api.testing
+MIGRATION_MODULES = {'api': None}
+TEST_RUNNER = 'api.testing.UnmanagedModelTestRunner'
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+LOGGING['loggers']['api']['handlers'] = ['file']
+
+# Tests flush the carts themselves
+CART_FLUSH_INTERVAL = 60 * 60